@@ -0,0 +1,324 @@
+"""
+Times the slow parts of making and printing lists and photos.
+
+Runs on any Linux box, no camera or printer needed: photos are made up
+and printing goes to a fake printer that throws the bytes away.
+
+    python3 benchmarks/run.py               # run everything
+    python3 benchmarks/run.py --quick       # skip the 1000 entry lists
+    python3 benchmarks/run.py -k photo      # only benchmarks with "photo" in the name
+    python3 benchmarks/run.py --save        # store the results as the baseline
+
+Every run is compared against the baseline (if there is one) and anything
+that got slower by more than --tolerance is flagged. The exit code is 1 if
+something regressed, so it can run in CI.
+
+Baselines only make sense on the machine they were made on.
+"""
+import argparse
+import atexit
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "src", "listmaker"))
+sys.path.append(os.path.join(ROOT, "src", "camera"))
+
+from PIL import Image
+from escpos.printer import Dummy
+import numpy as np
+
+from dither import ALGORITHMS, dither
+from image import ListImage
+from prerender import Prerenderer
+from raster import encode, pack
+from spooler import Spooler
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+LIST_TYPES = ("checkbox", "bullet", "number", "arrow", "arrowhead", "triangle")
+ENTRY_COUNTS = (1, 10, 100, 1000)
+
+# Size of a full resolution picture from the Camera Module V1
+PHOTO_SIZE = (2592, 1944)
+
+
+class FakeUsb(Dummy):
+    """
+    Stands in for escpos.printer.Usb. Counts the bytes instead of
+    sending them, so only our own overhead gets measured.
+    """
+    def __init__(self):
+        super().__init__(profile="TM-T88V")
+        self.sent = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _raw(self, msg):
+        self.sent += len(msg)
+
+
+def list_options(list_type, entries, separators, notes):
+    options = {
+        "list_type": list_type,
+        "title": "Benchmark",
+        "has_notes": notes,
+        "has_separators": separators,
+        "entries": [f"Entry number {i} with a few words in it" for i in range(entries)],
+    }
+
+    if notes:
+        options["notes"] = "Some notes at the bottom of the list " * 10
+
+    return options
+
+
+def make_photo(directory):
+    """
+    A JPEG the size of a real picture, with gradients for the midtones
+    and noise so it doesn't compress down to nothing
+    """
+    width, height = PHOTO_SIZE
+    rng = np.random.default_rng(440)
+
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:, None]
+    gray = (x + y) / 2 + rng.normal(0, 20, (height, width))
+    rgb = np.stack([gray, np.roll(gray, 100, axis=1), gray[::-1]], axis=2)
+
+    path = os.path.join(directory, "photo.jpg")
+    Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+    return path
+
+
+def benchmarks(quick=False):
+    """
+    Every benchmark as (name, function). Setup happens out here,
+    only calling the function gets timed.
+    """
+    list_image = ListImage()
+    counts = [count for count in ENTRY_COUNTS if not (quick and count >= 1000)]
+
+    # ListImage.generate(), from scratch every time (no cached tiles)
+    def render(options, mode=None):
+        def run():
+            list_image._tiles.clear()
+            list_image.generate(options, mode)
+
+        return run
+
+    def render_bands(options):
+        def run():
+            list_image._tiles.clear()
+
+            for band in list_image.bands(options):
+                encode(band)
+
+        return run
+
+    for list_type, count, separators, notes in itertools.product(LIST_TYPES, counts, (False, True), (False, True)):
+        options = list_options(list_type, count, separators, notes)
+        name = f"generate/{list_type}/{count}" + ("/separators" if separators else "") + ("/notes" if notes else "")
+        yield name, render(options)
+
+    # Changing one entry of a list that's already on screen
+    for count in counts:
+        options = list_options("checkbox", count, False, True)
+        list_image.generate(options)
+
+        def edit(options=options, toggle=itertools.cycle(("a", "b"))):
+            options["entries"][0] = next(toggle)
+            list_image.generate(options)
+
+        yield f"generate/edit-one-entry/{count}", edit
+
+    # How long until the printer gets its first band, see ListImage.bands()
+    for count in counts:
+        options = list_options("checkbox", count, True, True)
+
+        def first_band(options=options):
+            list_image._tiles.clear()
+            bands = list_image.bands(options, band_height=24)
+            next(bands)
+            bands.close()
+
+        yield f"bands/first-band/{count}", first_band
+        yield f"bands/all/{count}", render_bands(options)
+
+    # Image -> printer conversion, ours next to python-escpos' printer.image()
+    for count in counts:
+        options = list_options("checkbox", count, True, True)
+        image = list_image.generate(options, mode="1")
+        gray = list_image.generate(options)
+
+        yield f"raster/pack+encode/{count}", lambda image=image: encode(pack(image))
+        yield f"raster/pack+encode-no-skip/{count}", lambda image=image: encode(pack(image), skip_blank=False)
+        yield f"raster/pack+encode-graphics/{count}", lambda image=image: encode(pack(image), impl="graphics")
+        yield f"raster/pack+encode-from-L/{count}", lambda gray=gray: encode(pack(gray))
+        yield f"raster/escpos-printer.image/{count}", lambda image=image: Dummy(profile="TM-T88V").image(image)
+
+    # Photo path of print_latest_img(): open, dither, pack, encode
+    directory = tempfile.mkdtemp(prefix="listmaker-bench-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    photo = make_photo(directory)
+
+    for algorithm in ALGORITHMS:
+        def render_photo(algorithm=algorithm):
+            return encode(pack(dither(Image.open(photo), algorithm)))
+
+        yield f"photo/{algorithm}", render_photo
+
+    # Printing a picture that was already rendered when it was taken
+    prerender = Prerenderer(lambda path: encode(pack(dither(Image.open(path)))))
+    prerender.prepare(photo)
+    prerender.get(photo)
+    yield "photo/prerendered-get", lambda: prerender.get(photo)
+
+    # End to end through the spooler: render, encode, print, cut
+    printer = FakeUsb()
+    spooler = Spooler(connect=lambda: printer)
+
+    for count in counts:
+        options = list_options("checkbox", count, True, True)
+
+        def submit(options=options):
+            list_image._tiles.clear()
+            list_image.generate(options, mode="1")
+            spooler.submit(encode(list_image.raster())).wait()
+
+        yield f"print/list/{count}", submit
+
+    def submit_photo():
+        spooler.submit(encode(pack(dither(Image.open(photo))))).wait()
+
+    yield "print/photo", submit_photo
+
+
+def measure(function, repeat, min_time=0.05):
+    """
+    Median seconds per call. Fast functions are called in a loop
+    until a sample takes at least min_time, so timer resolution
+    doesn't matter.
+    """
+    start = time.perf_counter()
+    function()
+    once = time.perf_counter() - start
+
+    loops = max(1, int(min_time / once)) if once else 1000
+    samples = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for _ in range(loops):
+            function()
+
+        samples.append((time.perf_counter() - start) / loops)
+
+    return statistics.median(samples), min(samples)
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return json.load(file).get("results", {})
+
+
+def save_baseline(path, results):
+    # Keep baselines of benchmarks that were skipped this time (-k, --quick)
+    results = {**load_baseline(path), **results}
+
+    baseline = {
+        "machine": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": dict(sorted(results.items())),
+    }
+
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2)
+        file.write("\n")
+
+
+def format_time(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f}s"
+
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+
+    return f"{seconds * 1e6:.1f}us"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for rendering, encoding and printing.")
+    parser.add_argument("-k", dest="match", help="Only run benchmarks with this in their name")
+    parser.add_argument("--quick", action="store_true", help="Skip the 1000 entry lists")
+    parser.add_argument("--repeat", type=int, default=5, help="Samples per benchmark (default: 5)")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower than the baseline counts as a regression (default: 0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    # ListImage loads its fonts from ./assets
+    os.chdir(ROOT)
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+
+    print(f"{'benchmark':<48} {'median':>10} {'min':>10} {'baseline':>10}")
+
+    for name, function in benchmarks(args.quick):
+        if args.match and args.match not in name:
+            continue
+
+        median, fastest = measure(function, args.repeat)
+        results[name] = median
+
+        line = f"{name:<48} {format_time(median):>10} {format_time(fastest):>10}"
+        before = baseline.get(name)
+
+        if before:
+            change = median / before - 1
+            line += f" {format_time(before):>10} {change:+7.1%}"
+
+            if change > args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+
+        print(line, flush=True)
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) got slower by more than {args.tolerance:.0%}:")
+
+        for name in regressions:
+            print(f"    {name}")
+
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,157 +1,270 @@
-from gpiozero import Button, DigitalOutputDevice, RGBLED
+from gpiozero import Button, RGBLED
 from signal import pause
 from picamera2 import Picamera2, Preview
-from escpos.printer import Usb
-from escpos.exceptions import Error
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import time
 import os
+import sys
 import traceback
 from dotenv import load_dotenv
 
+# Printing code is shared with the list maker, camera code lives next to it
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "listmaker"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "camera"))
+from raster import PRINTER_WIDTH, Raster, pack, encode
+from dither import dither, fit
+from metrics import span, timed
+from spooler import PrinterPool
+from controller import Action, Channel, show, blink
+from tone import Buzzer, SHUTTER
+from archive import Archive
+from prerender import Prerenderer
+
 # Load environment variables from .env
 load_dotenv()
 
+# Grab the directory to save images from env variable.
+# If env variable isn't set, use current directory
+IMAGE_DIR = os.environ.get("IMAGE_DIR") or os.getcwd()
+
+# How much the picture archive can keep before the least recently
+# used pictures are deleted. Nothing is ever deleted unless one is set.
+ARCHIVE_MAX_MB = float(os.environ.get("ARCHIVE_MAX_MB") or "inf")
+ARCHIVE_MAX_PICTURES = int(os.environ.get("ARCHIVE_MAX_PICTURES") or 0) or None
+ARCHIVE_MAX_DAYS = float(os.environ.get("ARCHIVE_MAX_DAYS") or "inf")
+
 # RGB LED colors
 YELLOW = (0.5, 0.5, 0)
 BLUE   = (0, 0, 0.5)
 GREEN  = (0, 0.5, 0)
 RED    = (0.5, 0, 0)
 
+# Seconds a button has to settle before another press counts
+DEBOUNCE = 0.05
+
+# "lores" grabs the picture for the printer straight from the camera's
+# grayscale stream and saves the JPEG in the background. "file" saves
+# the JPEG first and prints from that, like it used to.
+CAPTURE = os.environ.get("CAPTURE") or "lores"
+
+# The lores stream is already as wide as the paper (4:3, like the sensor).
+# It can't be bigger than the main stream, which is also what's saved as JPEG.
+PRINT_SIZE = (PRINTER_WIDTH, PRINTER_WIDTH * 3 // 4)
+PREVIEW_SIZE = (640, 480)
+
 picam2 = Picamera2()
 led = RGBLED(red=14, green=15, blue=18)
+# Owns the printer connections for as long as the program runs,
+# pictures print on whichever printer is free
+spooler = PrinterPool()
+# LED and buzzer feedback plays in the background
+light = Channel()
+buzzer = Buzzer(16, 21)
+# Names, keeps and prunes the pictures, knows which one is the newest
+# without scanning the directory
+archive = Archive(
+    IMAGE_DIR,
+    max_bytes=ARCHIVE_MAX_MB * 1e6,
+    max_count=ARCHIVE_MAX_PICTURES,
+    max_age=ARCHIVE_MAX_DAYS * 24 * 60 * 60,
+)
+# Saves JPEGs one at a time in the background, so the SD card
+# doesn't hold up taking (and printing) the picture
+archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
 
-def play_tone(frequency, duration):
+
+def render_image(image) -> Raster:
     """
-    Note: I'm using a passive buzzer (piezo transducer) 
-    that needs an external oscillating signal. This is 
-    different from a self-oscillating active buzzer.
-    
-    Passive buzzers can play a variety of tones with pitch control
-    just by changing the frequency and duration of the signal.
-    
-    Differences explained here:
-    https://arduinogetstarted.com/tutorials/arduino-piezo-buzzer
-    
-    :param frequency: Frequency of tone in hertz (hz)
-    :param duration: Time in seconds
+    Dither a paper wide grayscale image down to black and white dots
     """
-    pin_1 = DigitalOutputDevice(16)
-    pin_2 = DigitalOutputDevice(21)
-    
-    # T = 1 / f
-    # where T is the time to complete one cycle
-    # and f is frequency in hertz
-    period = 1.0 / frequency
-    # For a 50% duty cycle
-    pulse_width = period / 2 
-    cycles = int(duration * frequency)
-    
-    for i in range(cycles):
-        pin_1.on()
-        pin_2.off()
-        time.sleep(pulse_width)
-        pin_2.on()
-        pin_1.off()
-        time.sleep(pulse_width)
-    
+    algorithm = os.environ.get("DITHER") or "atkinson"
+
+    with span("dither", algorithm=algorithm):
+        photo = dither(image, algorithm)
+
+    with span("pack"):
+        return pack(photo)
 
+
+def render_photo(path):
+    """
+    Encode a picture for printing. Its raster is normally saved next to it,
+    pictures without one are rendered from the JPEG once and get one saved.
+    """
+    raster = archive.raster(path)
+
+    if raster is None:
+        with span("decode"):
+            photo = fit(Image.open(path))
+
+        raster = render_image(photo)
+        archive.save_raster(path, raster)
+
+    with span("encode"):
+        return encode(raster)
+
+
+def save_picture(picture, path, raster, payload):
+    """
+    Runs on the archiver thread. The picture only shows up in the archive
+    once it's saved, with its print payload already in the cache.
+    """
+    with span("archive"):
+        # JPEGs can't have the alpha channel the camera's XBGR format comes with
+        picture.convert("RGB").save(path, quality=90)
+        archive.add(path, raster)
+
+    prerender.put(path, payload)
+
+
+def saved(future):
+    """
+    Called once save_picture() is done. Nobody waits for it, so this is
+    the only place a picture that couldn't be saved (e.g. the SD card
+    is full) gets noticed.
+    """
+    error = future.exception()
+
+    if error is None:
+        return
+
+    traceback.print_exception(error)
+    print("ERROR: Picture couldn't be saved")
+
+    # Same as printer errors that aren't about the printer being gone
+    light.play(show(led, RED, 5))
+
+
+# Renders new pictures for printing in the background as they're taken
+prerender = Prerenderer(render_photo)
+
+@timed("take_picture")
 def take_picture():
     print('Taking picture...')
     
     # Turn yellow while picture is being captured
-    led.color = YELLOW
+    light.play(show(led, YELLOW))
     
-    # Notification sound
-    play_tone(440, 0.25) # A4
-    play_tone(220, 0.125) # A3
-    play_tone(110, 0.0625) # A2
+    # Notification sound plays while the picture is taken
+    buzzer.play(SHUTTER)
     
-    local_time = time.localtime()
-    timestamp_img = '{}.jpg'.format(time.asctime(local_time))
-    
-    # Grab the directory to save image from env variable.
-    # If env variable isn't set, use current directory
-    directory = os.environ["IMAGE_DIR"] or os.cwd()
-    picam2.capture_file(os.path.join(directory, timestamp_img))
+    image_path = archive.new_path()
+
+    if CAPTURE == "lores":
+        with span("capture"):
+            request = picam2.capture_request()
+
+            try:
+                # The Y plane of YUV420 is the grayscale picture, the rows
+                # can be padded so it gets cut down to the actual size
+                width, height = PRINT_SIZE
+                gray = np.array(request.make_array("lores")[:height, :width])
+                picture = request.make_image("main")
+            finally:
+                request.release()
+
+        # No JPEG to decode and nothing to resize, it goes straight to dithering
+        raster = render_image(Image.fromarray(gray))
+
+        with span("encode"):
+            payload = encode(raster)
+
+        saving = archiver.submit(save_picture, picture, image_path, raster, payload)
+    else:
+        with span("capture"):
+            picam2.capture_file(image_path)
+
+        archive.add(image_path)
+        prerender.prepare(image_path)
+        saving = None
+
+    light.cancel()
     led.off()
-    print("Picture saved:", timestamp_img)
 
+    # Only now, so a save that already failed isn't turned off again right away
+    if saving is not None:
+        saving.add_done_callback(saved)
+
+    print("Picture saved:", os.path.relpath(image_path, IMAGE_DIR))
 
+
+@timed("print_latest_img")
 def print_latest_img():
-    # Grab the directory to save image from env variable.
-    # If env variable isn't set, use current directory
-    directory = os.environ["IMAGE_DIR"] or os.cwd()
-    files = os.listdir(directory)
-    # Grab a a list of all jpeg image file paths
-    images = [file for file in files if file.endswith('.jpg')]
-    latest_img = max(images, key=os.path.getctime)
+    # Waits for pictures that are still being saved, so the newest one counts
+    archiver.submit(lambda: None).result()
+
+    with span("lookup"):
+        latest_img = archive.latest()
+    
+    if latest_img is None:
+        print("No pictures to print yet")
+        return
     
     print("Starting print job...")
     
-    try:
-        printer = Usb(idVendor=int(os.environ["VENDOR_ID"], 16),
-                      idProduct=int(os.environ["PRODUCT_ID"], 16),
-                      in_ep=int(os.environ["IN_EP"], 16),
-                      out_ep=int(os.environ["OUT_EP"], 16),
-                      profile="TM-T88V")
-        
-        # Show blue color to represent ongoing print job
-        led.color = BLUE
-        
-        printer.image(latest_img)
-        printer.cut()
-        
-    except Error as err:
+    # Show blue color to represent ongoing print job
+    light.play(show(led, BLUE))
+    
+    # Usually rendered already when the picture was taken
+    with span("prerender_get"):
+        payload = prerender.get(latest_img)
+
+    with span("print", bytes=len(payload)):
+        job = spooler.submit(payload)
+        job.wait()
+
+    if job.error:
         device_not_found = 90
         usb_not_found = 91
         
-        traceback.print_exc()
-        print(f'ERROR {err.resultcode}: {err.msg}')
-        
         # Blink RGB LED 3 times for DeviceNotFoundError
-        if err.resultcode == device_not_found:
-            led.blink(on_color=RED)
-            time.sleep(5)
+        if job.error.resultcode == device_not_found:
+            light.play(blink(led, RED, 3))
             
         # Blink RGB LED 2 times for USBNotFoundError
-        elif err.resultcode == usb_not_found:
-            led.blink(on_color=RED)
-            time.sleep(3)
+        elif job.error.resultcode == usb_not_found:
+            light.play(blink(led, RED, 2))
             
         # For all other errors, make RGB LED red for 5 secs
         else:
-            led.color = RED
-            time.sleep(5)
+            light.play(show(led, RED, 5))
         
-        led.off()
-        quit()
+        # The spooler keeps running, so the next press tries again
+        return
     
+    # Pictures that get printed are kept the longest
+    archive.touch(latest_img)
+
     print("Finished printing")
-    printer.close()
     # Show green color for print success
-    led.color = GREEN
-    time.sleep(3)
-    led.off()
+    light.play(show(led, GREEN, 3))
     
 
 
 def run():
     print('Running program...')
     
-    # Create camera preview
-    camera_config = picam2.create_preview_configuration(main={"size": (480, 360)})
+    # Create camera preview, lores is the grayscale picture for the printer
+    camera_config = picam2.create_preview_configuration(
+        main={"size": PREVIEW_SIZE},
+        lores={"size": PRINT_SIZE, "format": "YUV420"},
+    )
     picam2.configure(camera_config)
     picam2.start_preview(Preview.QTGL)
     picam2.start()
     time.sleep(2)
     
-    # Button to take and save a picture
-    shutter_button = Button(6) 
-    shutter_button.when_pressed = take_picture
+    # Button to take and save a picture.
+    # Every press takes a picture, one after another
+    shutter_button = Button(6, bounce_time=DEBOUNCE) 
+    shutter_button.when_pressed = Action(take_picture).press
     
-    # Button to print latest image to thermal printer
-    print_button = Button(24)
-    print_button.when_pressed = print_latest_img
+    # Button to print latest image to thermal printer.
+    # Presses while a print is still waiting to start get merged into it
+    print_button = Button(24, bounce_time=DEBOUNCE)
+    print_button.when_pressed = Action(print_latest_img, coalesce=True).press
     
     pause()
     
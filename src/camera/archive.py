@@ -0,0 +1,334 @@
+from dataclasses import dataclass
+import bisect
+import os
+import re
+import threading
+import time
+
+from files import replace
+from raster import Raster, from_pbm, to_pbm
+
+# Pictures are kept in one directory per day, e.g. 2026-10-17/20261017-153012-123456.jpg
+SHARD = re.compile(r"\d{4}-\d{2}-\d{2}")
+NAME = re.compile(r"\d{8}-\d{6}-\d{6}")
+
+# Names from before the archive, made with time.asctime(), e.g. "Sat Oct 17 15:30:12 2026"
+LEGACY_NAME = re.compile(r"\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4}")
+
+# The print raster saved next to every picture
+RASTER_EXTENSION = ".pbm"
+
+
+@dataclass
+class Picture:
+    """
+    A picture in the archive. taken is when it was saved (mtime), used is
+    when it was last taken or printed (atime). size counts the picture
+    and its print raster together.
+    """
+    path: str
+    taken: float
+    used: float
+    size: int
+
+
+class Archive:
+    def __init__(self, directory, max_bytes=None, max_count=None, max_age=None, extension=".jpg"):
+        """
+        Keeps the pictures the camera takes, within a budget.
+
+        Every picture gets a name from new_path(): the UTC time it was taken
+        down to the microsecond, so names sort in the order pictures were
+        taken and never collide, even for two pictures in the same second.
+        Pictures are split into one directory per day, so no directory
+        grows so big that listing it gets slow.
+
+        Next to every picture its print raster is saved as a 1-bit PBM,
+        about 25 KB for a paper wide picture. Printing it again only means
+        reading that file back, the picture never has to be decoded.
+
+        When the archive goes over max_bytes or max_count, the pictures
+        that were least recently taken or printed are deleted first.
+        Pictures older than max_age are deleted no matter what.
+        None means no limit.
+
+        Only files the archive named itself are ever deleted, plus pictures
+        with the old time.asctime() names at the top of the directory.
+        Anything else in there is left alone and ignored.
+
+        :param directory: Where the pictures are saved
+        :param max_bytes: Most bytes all pictures and rasters can take up
+        :param max_count: Most pictures to keep
+        :param max_age: Most seconds to keep a picture
+        :param extension: File extension of the pictures
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_age = max_age
+        self.extension = extension
+
+        # Sorted oldest first by (taken, path), so the latest picture is always the last one
+        self._pictures = []
+        self._by_path = {}
+        self._bytes = 0
+        # Last timestamp handed out by new_path(), in microseconds, and its directory
+        self._stamp = 0
+        self._shard = None
+        self._lock = threading.RLock()
+
+        self.rescan()
+
+    def new_path(self) -> str:
+        """
+        Where to save the next picture. The day's directory is made if needed.
+        """
+        with self._lock:
+            # Always later than the last name, even if the clock hasn't moved
+            stamp = max(time.time_ns() // 1000, self._stamp + 1)
+
+            while True:
+                seconds, micros = divmod(stamp, 1_000_000)
+                utc = time.gmtime(seconds)
+                shard = os.path.join(self.directory, time.strftime("%Y-%m-%d", utc))
+                path = os.path.join(shard, time.strftime("%Y%m%d-%H%M%S", utc) + f"-{micros:06d}{self.extension}")
+
+                # Left over from a run with the clock set ahead
+                if not os.path.exists(path):
+                    break
+
+                stamp += 1
+
+            self._stamp = stamp
+            self._shard = shard
+
+        os.makedirs(shard, exist_ok=True)
+        return path
+
+    def rescan(self):
+        """
+        Rebuilds the index from whatever is on the SD card right now,
+        then deletes whatever doesn't fit the budget
+        """
+        pictures = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_dir() and SHARD.fullmatch(entry.name):
+                    with os.scandir(entry.path) as shard:
+                        pictures.extend(self._scan(shard, NAME))
+                elif entry.is_file():
+                    pictures.extend(self._scan([entry], LEGACY_NAME))
+
+        pictures.sort(key=_order)
+
+        with self._lock:
+            self._pictures = pictures
+            self._by_path = {picture.path: picture for picture in pictures}
+            self._bytes = sum(picture.size for picture in pictures)
+
+        self.evict()
+
+    def add(self, path, raster: Raster = None):
+        """
+        Adds a newly saved picture, along with its print raster if there is one,
+        then makes room for it. The new picture itself is never deleted.
+        New pictures are almost always the newest, so this is usually just an append.
+        """
+        path = os.path.abspath(path)
+
+        if raster is not None:
+            self._write_raster(path, raster)
+
+        stat = os.stat(path)
+        picture = Picture(path, stat.st_mtime, time.time(), stat.st_size + self._raster_size(path))
+
+        with self._lock:
+            self._remove(path)
+            key = _order(picture)
+
+            if not self._pictures or key >= _order(self._pictures[-1]):
+                self._pictures.append(picture)
+            else:
+                bisect.insort(self._pictures, picture, key=_order)
+
+            self._by_path[path] = picture
+            self._bytes += picture.size
+
+        self.evict(keep=path)
+
+    def save_raster(self, path, raster: Raster):
+        """
+        Saves the print raster of a picture that's already in the archive,
+        e.g. one from before rasters were kept
+        """
+        path = os.path.abspath(path)
+        self._write_raster(path, raster)
+
+        with self._lock:
+            picture = self._by_path.get(path)
+
+            if picture:
+                self._bytes -= picture.size
+                picture.size = os.path.getsize(path) + self._raster_size(path)
+                self._bytes += picture.size
+
+    def raster(self, path) -> Raster:
+        """
+        The saved print raster of a picture, None if it doesn't have one
+        """
+        try:
+            with open(self.raster_path(path), "rb") as file:
+                return from_pbm(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def raster_path(self, path) -> str:
+        return os.path.splitext(os.path.abspath(path))[0] + RASTER_EXTENSION
+
+    def touch(self, path):
+        """
+        Marks a picture as just used, so it's the last to be deleted.
+        It's kept as the access time, which survives restarts.
+        """
+        path = os.path.abspath(path)
+        now = time.time_ns()
+
+        with self._lock:
+            picture = self._by_path.get(path)
+
+            if picture is None:
+                return
+
+            picture.used = now / 1e9
+
+        try:
+            # Only the access time changes, the modification time
+            # is what pictures are sorted (and prerendered) by
+            os.utime(path, ns=(now, os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+
+    def latest(self):
+        """
+        Path of the newest picture, or None if there aren't any.
+        Pictures that were deleted behind our back get dropped on the way.
+        """
+        with self._lock:
+            while self._pictures:
+                path = self._pictures[-1].path
+
+                if os.path.exists(path):
+                    return path
+
+                self._remove(path)
+
+        return None
+
+    def evict(self, keep=None):
+        """
+        Deletes pictures until the archive fits its budget.
+
+        :param keep: Path of a picture that mustn't be deleted
+        :return: Paths of the deleted pictures
+        """
+        now = time.time()
+        victims = []
+
+        with self._lock:
+            if self.max_age is not None:
+                victims.extend(
+                    picture for picture in self._pictures
+                    if now - picture.taken > self.max_age and picture.path != keep
+                )
+
+                for picture in victims:
+                    self._remove(picture.path)
+
+            # Least recently used first
+            candidates = sorted(
+                (picture for picture in self._pictures if picture.path != keep),
+                key=lambda picture: picture.used,
+                reverse=True,
+            )
+
+            while candidates and self._over_budget():
+                picture = candidates.pop()
+                self._remove(picture.path)
+                victims.append(picture)
+
+        for picture in victims:
+            self._delete(picture.path)
+
+        if victims:
+            print(f"Deleted {len(victims)} old picture(s), {len(self)} left using {self._bytes / 1e6:.1f} MB")
+
+        return [picture.path for picture in victims]
+
+    def __len__(self):
+        return len(self._pictures)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def _over_budget(self):
+        return (
+            (self.max_count is not None and len(self._pictures) > self.max_count)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        )
+
+    def _scan(self, entries, pattern):
+        for entry in entries:
+            name, extension = os.path.splitext(entry.name)
+
+            if extension != self.extension or not pattern.fullmatch(name) or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            size = stat.st_size + self._raster_size(entry.path)
+            yield Picture(entry.path, stat.st_mtime, max(stat.st_atime, stat.st_mtime), size)
+
+    def _raster_size(self, path):
+        try:
+            return os.path.getsize(self.raster_path(path))
+        except OSError:
+            return 0
+
+    def _write_raster(self, path, raster):
+        # A reprint never reads half a raster
+        with replace(self.raster_path(path)) as file:
+            file.write(to_pbm(raster))
+
+    def _remove(self, path):
+        """
+        Drops a picture from the index, the files stay where they are
+        """
+        picture = self._by_path.pop(path, None)
+
+        if picture is None:
+            return
+
+        self._pictures.remove(picture)
+        self._bytes -= picture.size
+
+    def _delete(self, path):
+        for file in (path, self.raster_path(path)):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+        shard = os.path.dirname(path)
+
+        # The day's directory goes once its last picture is gone,
+        # unless the next picture is about to be saved in it
+        if shard not in (self.directory, self._shard):
+            try:
+                os.rmdir(shard)
+            except OSError:
+                pass
+
+
+def _order(picture):
+    return (picture.taken, picture.path)
@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import traceback
+
+
+class Action:
+    def __init__(self, function, coalesce=False):
+        """
+        Wraps a button callback so it runs on its own worker thread.
+        Hook press up to gpiozero, e.g. button.when_pressed = Action(fn).press
+
+        gpiozero calls when_pressed callbacks on its pin thread, so anything
+        slow in there (tones, USB, sleeping) holds up every other button.
+        Instead the press gets queued and the callback returns right away.
+
+        Each Action has a single worker, so presses of the same button still
+        run one after another, while different buttons run side by side.
+
+        :param function: What to run when the button is pressed
+        :param coalesce: If True, a press that comes in while another one is
+                         still waiting in the queue is dropped. Good for
+                         printing, where mashing the button shouldn't
+                         queue up ten copies.
+        """
+        self.function = function
+        self.coalesce = coalesce
+
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=function.__name__)
+
+    def press(self):
+        with self._lock:
+            if self.coalesce and self._pending:
+                print(f"{self.function.__name__} is already queued, ignoring press")
+                return
+
+            self._pending += 1
+
+        self._worker.submit(self._run)
+
+    def _run(self):
+        with self._lock:
+            self._pending -= 1
+
+        try:
+            self.function()
+        except Exception:
+            # Keep the worker alive for the next press
+            traceback.print_exc()
+
+
+class Channel:
+    def __init__(self):
+        """
+        Plays one effect at a time on a piece of hardware, e.g. the RGB LED
+        or the buzzer.
+
+        Effects run in the background. Starting a new effect cancels the one
+        that is currently playing, so a green "print done" doesn't get stuck
+        behind the tail end of an older blink.
+
+        An effect is a function that takes a threading.Event. It should
+        stop as soon as the event is set, stop.wait(seconds) instead of
+        time.sleep(seconds) does that for free.
+        """
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def play(self, effect, *args):
+        with self._lock:
+            self._stop.set()
+
+            # Wait for the old effect to let go of the hardware,
+            # this is quick since it was just told to stop
+            if self._thread:
+                self._thread.join()
+
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=effect, args=(self._stop, *args), daemon=True)
+            self._thread.start()
+
+    def cancel(self):
+        with self._lock:
+            self._stop.set()
+
+
+def show(led, color, seconds=None):
+    """
+    LED effect that holds a color, then turns off after the given seconds.
+    Without seconds the color stays until the next effect.
+    """
+    def effect(stop):
+        if stop.is_set():
+            return
+
+        led.color = color
+
+        if seconds is not None and not stop.wait(seconds):
+            led.off()
+
+    return effect
+
+
+def blink(led, color, times, on_time=0.5, off_time=0.5):
+    """
+    LED effect that blinks a color a number of times
+    """
+    def effect(stop):
+        for _ in range(times):
+            led.color = color
+            if stop.wait(on_time):
+                return
+
+            led.off()
+            if stop.wait(off_time):
+                return
+
+    return effect
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import traceback
+
+
+class Prerenderer:
+    def __init__(self, render, size=8):
+        """
+        Gets pictures ready for printing before anyone asks for them.
+
+        Right after a picture is taken, prepare() renders it into a print
+        payload on a background thread. When the print button is pressed
+        the payload is already sitting in the cache and only has to be sent.
+
+        The cache is keyed by path and modification time, so a file that
+        was overwritten is never printed from a stale payload. Only the
+        most recently used payloads are kept around.
+
+        :param render: Function that turns a picture path into a payload
+        :param size: How many payloads the cache holds
+        """
+        self.render = render
+        self.size = size
+
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prerender")
+
+    def prepare(self, path):
+        """
+        Starts rendering a picture in the background
+        """
+        key = self._key(path)
+
+        with self._lock:
+            if key in self._cache or key in self._pending:
+                return
+
+            self._pending[key] = self._worker.submit(self._background, key)
+
+    def put(self, path, payload):
+        """
+        Adds a payload that was rendered somewhere else, e.g. straight from the camera
+        """
+        key = self._key(path)
+
+        with self._lock:
+            self._store(key, payload)
+
+    def get(self, path) -> bytes:
+        """
+        The payload for a picture. Comes from the cache if it's there, waits
+        for it if it's still rendering, otherwise renders it right now.
+        """
+        key = self._key(path)
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            pending = self._pending.get(key)
+
+        if pending:
+            payload = pending.result()
+
+            if payload is not None:
+                return payload
+
+        print("Picture wasn't ready, rendering now...")
+        return self._render(key)
+
+    def _key(self, path):
+        path = os.path.abspath(path)
+        return (path, os.path.getmtime(path))
+
+    def _background(self, key):
+        try:
+            return self._render(key)
+        except Exception:
+            # Only log it, get() will try again when the picture is printed
+            traceback.print_exc()
+
+            with self._lock:
+                self._pending.pop(key, None)
+
+            return None
+
+    def _render(self, key):
+        path, _ = key
+        payload = self.render(path)
+
+        with self._lock:
+            self._pending.pop(key, None)
+            self._store(key, payload)
+
+        return payload
+
+    def _store(self, key, payload):
+        self._cache[key] = payload
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
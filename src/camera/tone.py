@@ -0,0 +1,69 @@
+from gpiozero import DigitalOutputDevice, PWMOutputDevice
+
+from controller import Channel
+from metrics import span
+
+"""
+Songs are tuples of (frequency in hertz, duration in seconds)
+"""
+SHUTTER = (
+    (440, 0.25),    # A4
+    (220, 0.125),   # A3
+    (110, 0.0625),  # A2
+)
+
+
+class Buzzer:
+    def __init__(self, pin=16, ground=21):
+        """
+        Note: I'm using a passive buzzer (piezo transducer)
+        that needs an external oscillating signal. This is
+        different from a self-oscillating active buzzer.
+
+        Passive buzzers can play a variety of tones with pitch control
+        just by changing the frequency and duration of the signal.
+
+        Differences explained here:
+        https://arduinogetstarted.com/tutorials/arduino-piezo-buzzer
+
+        Instead of toggling the pins from Python, the square wave comes
+        from PWM at a 50% duty cycle. The frequency of the PWM signal is
+        the pitch of the note, so the timing is done by the GPIO library
+        (or the hardware with pigpio) and Python only has to change notes.
+
+        The pins are opened once here and stay open.
+
+        :param pin: GPIO pin the PWM signal goes out on
+        :param ground: GPIO pin on the other leg of the buzzer, held low
+        """
+        self.pwm = PWMOutputDevice(pin, initial_value=0, frequency=440)
+        self.ground = DigitalOutputDevice(ground, initial_value=False)
+        self._channel = Channel()
+
+    def play(self, notes):
+        """
+        Starts playing the notes in the background and returns right away.
+        Anything that was already playing gets cut off.
+        """
+        self._channel.play(self._melody, notes)
+
+    def stop(self):
+        self._channel.cancel()
+
+    def close(self):
+        self.stop()
+        self.pwm.close()
+        self.ground.close()
+
+    def _melody(self, stop, notes):
+        with span("tone", notes=len(notes)):
+            try:
+                for frequency, duration in notes:
+                    self.pwm.frequency = frequency
+                    # 50% duty cycle
+                    self.pwm.value = 0.5
+
+                    if stop.wait(duration):
+                        break
+            finally:
+                self.pwm.off()
@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from image import ListImage
+from raster import encode
+from textlist import TextList
+from spooler import PrinterPool
+
+# Same choices as the radio buttons in the GUI
+LIST_TYPES = ("checkbox", "bullet", "number", "arrow", "arrowhead", "triangle")
+
+WHITESPACE = re.compile(r"\s*")
+
+# One ListImage and TextList per worker process, made by _start_worker()
+_list_image = None
+_text_list = None
+
+
+def parse_options(raw) -> dict:
+    """
+    Turns a list definition from a file into the same options dict
+    MainApplication.get_settings() makes, filling in the GUI defaults:
+
+        title: Groceries
+        list_type: checkbox
+        has_separators: false
+        entries:
+          - Eggs
+          - Milk
+        notes: Get the big one
+
+    has_notes defaults to whether there are notes at all.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError(f"A list has to be a mapping, got {type(raw).__name__}")
+
+    list_type = raw.get("list_type", "checkbox")
+
+    if list_type not in LIST_TYPES:
+        raise ValueError(f"Unknown list_type: {list_type}")
+
+    entries = [str(entry) for entry in raw.get("entries") or []]
+
+    options = {
+        "list_type": list_type,
+        "title": str(raw.get("title") or ""),
+        "has_notes": bool(raw.get("has_notes", bool(raw.get("notes")))),
+        "has_separators": bool(raw.get("has_separators", False)),
+        # Removes all entries that are only whitespace, same as the GUI
+        "entries": [entry for entry in entries if entry.strip()],
+    }
+
+    if options["has_notes"]:
+        options["notes"] = str(raw.get("notes") or "")
+
+    return options
+
+
+def read_documents(text, fmt):
+    """
+    Every list definition in a file.
+
+    JSON files can hold one object, an array of them or one object per
+    line (JSON Lines). YAML files can hold a mapping, a sequence of them
+    or several documents separated by ---.
+    """
+    if fmt == "json":
+        decoder = json.JSONDecoder()
+        documents = []
+        position = 0
+
+        while True:
+            # Skip the whitespace (newlines for JSON Lines) between documents
+            position = WHITESPACE.match(text, position).end()
+
+            if position >= len(text):
+                break
+
+            document, position = decoder.raw_decode(text, position)
+            documents.append(document)
+    else:
+        documents = [document for document in yaml.safe_load_all(text) if document is not None]
+
+    lists = []
+
+    for document in documents:
+        if isinstance(document, list):
+            lists.extend(document)
+        else:
+            lists.append(document)
+
+    return lists
+
+
+def guess_format(path, text):
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in (".json", ".jsonl"):
+        return "json"
+
+    if extension in (".yaml", ".yml"):
+        return "yaml"
+
+    # Standard input has no extension to go by
+    return "json" if text.lstrip()[:1] in ("{", "[") else "yaml"
+
+
+def find_sources(paths) -> list:
+    """
+    Expands directories into the JSON and YAML files inside them, sorted
+    by name so the output comes out in the same order every time
+    """
+    sources = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith((".json", ".jsonl", ".yaml", ".yml")):
+                        sources.append(os.path.join(root, name))
+        else:
+            sources.append(path)
+
+    return sources
+
+
+def load_lists(sources, fmt=None):
+    """
+    Reads every source and yields (name, options) for each list in it.
+    name is used for the output files, e.g. shifts.yaml with three
+    lists in it gives shifts-1, shifts-2 and shifts-3.
+
+    Lists that can't be read are reported and yield options=None,
+    so they still count as failed.
+    """
+    for source in sources:
+        stem = "stdin" if source == "-" else os.path.splitext(os.path.basename(source))[0]
+
+        try:
+            if source == "-":
+                text = sys.stdin.read()
+            else:
+                with open(source, encoding="utf-8") as file:
+                    text = file.read()
+
+            documents = read_documents(text, fmt or guess_format(source, text))
+        except (OSError, ValueError, yaml.YAMLError) as err:
+            print(f"ERROR: Couldn't read {source}: {err}")
+            yield stem, None
+            continue
+
+        for index, document in enumerate(documents):
+            name = stem if len(documents) == 1 else f"{stem}-{index + 1}"
+
+            try:
+                yield name, parse_options(document)
+            except ValueError as err:
+                print(f"ERROR: {source} list {index + 1}: {err}")
+                yield name, None
+
+
+def safe_name(name):
+    return re.sub(r"[^\w.-]+", "_", name).strip("._") or "list"
+
+
+def _start_worker():
+    global _list_image, _text_list
+    _list_image = ListImage()
+    _text_list = TextList()
+
+
+def _render(job):
+    """
+    Runs in a worker process. Writes the files itself so only the
+    ESC/POS payload (if it's getting printed) has to come back.
+
+    :return: (name, payload or None, error message or None)
+    """
+    name, options, output, png, escpos, printing, impl = job
+
+    if options is None:
+        return name, None, "invalid list"
+
+    try:
+        if png:
+            # Same as Save Image in the GUI
+            _list_image.generate(options).save(os.path.join(output, f"{safe_name(name)}.png"))
+
+        payload = None
+
+        if (escpos or printing) and impl == "text":
+            if _list_image.is_empty(options):
+                raise TypeError("the list is empty")
+
+            payload = _text_list.encode(options)
+        elif escpos or printing:
+            # Printer only prints black dots so render 1-bit directly
+            _list_image.generate(options, mode="1")
+            payload = encode(_list_image.raster(), impl=impl)
+
+        if escpos:
+            with open(os.path.join(output, f"{safe_name(name)}.bin"), "wb") as file:
+                file.write(payload)
+    except TypeError:
+        return name, None, "the list is empty"
+    except OSError as err:
+        return name, None, str(err)
+
+    return name, payload if printing else None, None
+
+
+def run(lists, output=".", png=True, escpos=False, printing=False, impl="bitImageRaster", workers=None, spooler=None):
+    """
+    Renders lists across a pool of processes.
+
+    Results come back in the same order the lists went in, so printed
+    lists are handed to the printers in order too, even though they're
+    rendered in parallel. With several printers plugged in, each list
+    goes to whichever one is least busy. Printing starts as soon as the first list
+    is ready instead of after all of them are.
+
+    :param lists: (name, options) pairs, see load_lists()
+    :param output: Directory for the .png and .bin files
+    :param png: Save each list as a PNG
+    :param escpos: Save each list as a raw ESC/POS payload (.bin)
+    :param printing: Send each list to the printer
+    :param impl: ESC/POS image command, see raster.encode(), or "text" for textlist.py
+    :param workers: Number of processes, defaults to one per CPU
+    :param spooler: Spooler or PrinterPool to print with, a new pool is opened if needed
+    :return: (rendered, failed) counts
+    """
+    os.makedirs(output, exist_ok=True)
+
+    if printing and spooler is None:
+        spooler = PrinterPool()
+
+    jobs = ((name, options, output, png, escpos, printing, impl) for name, options in lists)
+    rendered = failed = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker) as pool:
+        for name, payload, error in pool.map(_render, jobs, chunksize=4):
+            if error:
+                print(f"ERROR: {name}: {error}")
+                failed += 1
+                continue
+
+            rendered += 1
+
+            if payload is not None:
+                spooler.submit(payload)
+
+    elapsed = time.perf_counter() - start
+    rate = rendered / elapsed if elapsed else 0
+    print(f"Rendered {rendered} lists in {elapsed:.2f}s ({rate:.1f} lists/sec), {failed} failed")
+
+    if printing:
+        # Waits for everything still queued to be printed
+        spooler.close()
+
+        elapsed = time.perf_counter() - start
+        print(f"Printed {rendered} lists in {elapsed:.2f}s ({rendered / elapsed:.1f} lists/sec)")
+
+    return rendered, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Renders lists from JSON or YAML files without the GUI.",
+    )
+    parser.add_argument("sources", nargs="*", default=["-"],
+                        help="List files or directories of them, - (default) reads standard input")
+    parser.add_argument("-o", "--output", default=".", help="Where to write the files (default: current directory)")
+    parser.add_argument("--png", action="store_true", help="Save every list as a PNG (default if nothing else is picked)")
+    parser.add_argument("--escpos", action="store_true", help="Save every list as a raw ESC/POS payload (.bin)")
+    parser.add_argument("--print", dest="printing", action="store_true", help="Print every list, in order")
+    parser.add_argument("--impl", choices=("bitImageRaster", "graphics", "text"), default="bitImageRaster",
+                        help="ESC/POS image command for --escpos and --print, text prints in the printer's font")
+    parser.add_argument("--format", choices=("json", "yaml"), help="Input format, guessed from the extension by default")
+    parser.add_argument("-j", "--workers", type=int, help="Number of worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    png = args.png or not (args.escpos or args.printing)
+    lists = load_lists(find_sources(args.sources), args.format)
+
+    _, failed = run(lists, args.output, png, args.escpos, args.printing, args.impl, args.workers)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+from PIL import Image
+import numpy as np
+
+from raster import PRINTER_WIDTH
+
+"""
+Error diffusion kernels as (dy, dx, weight).
+The error of each pixel gets pushed onto the neighbors below and to the right.
+
+Floyd-Steinberg:        Atkinson:
+        *   7               *   1   1
+    3   5   1           1   1   1
+                            1
+      (/ 16)                (/ 8, only 6/8 of the error is kept)
+"""
+FLOYD_STEINBERG = [(0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)]
+ATKINSON = [(0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)]
+
+# 8x8 Bayer matrix for ordered dithering
+BAYER_8 = np.array([
+    [ 0, 32,  8, 40,  2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44,  4, 36, 14, 46,  6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [ 3, 35, 11, 43,  1, 33,  9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47,  7, 39, 13, 45,  5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+])
+
+
+def fit(image: Image.Image, width=PRINTER_WIDTH) -> Image.Image:
+    """
+    Makes a grayscale copy of the image that is exactly as wide as the paper.
+
+    For JPEGs draft() lets the decoder skip straight to a smaller scale
+    (and grayscale) instead of decoding the full picture first.
+    """
+    height = round(image.height * width / image.width)
+    image.draft("L", (width, height))
+
+    gray = image.convert("L")
+
+    if gray.size != (width, height):
+        gray = gray.resize((width, height), Image.Resampling.BILINEAR)
+
+    return gray
+
+
+def threshold(gray: np.ndarray) -> np.ndarray:
+    return gray < 128
+
+
+def bayer(gray: np.ndarray) -> np.ndarray:
+    """
+    Ordered dithering, compares every pixel against a repeating
+    8x8 pattern of thresholds. No pixel depends on another so
+    it's done in one go for the whole image.
+    """
+    h, w = gray.shape
+    thresholds = (BAYER_8 + 0.5) * (256 / 64)
+    tiled = np.tile(thresholds, (h // 8 + 1, w // 8 + 1))[:h, :w]
+
+    return gray < tiled
+
+
+def _diffuse(gray: np.ndarray, kernel) -> np.ndarray:
+    """
+    Error diffusion, processed one diagonal at a time.
+
+    Normally every pixel has to wait for the one on its left. But with these
+    kernels a pixel at (y, x) only ever gets error from pixels with a smaller
+    x + 2y. So all the pixels on the same x + 2y "wavefront" are independent
+    and NumPy can do each wavefront in one step. That's W + 2H steps instead
+    of W * H.
+    """
+    h, w = gray.shape
+
+    # Padding so the kernel can spill over the edges without bounds checks.
+    # Everything works on the flattened buffer since 1D indexing is
+    # a lot cheaper than 2D fancy indexing.
+    stride = w + 4
+    buffer = np.zeros((h + 2, stride), dtype=np.float32)
+    buffer[:h, 2:w + 2] = gray
+    buffer = buffer.ravel()
+    black = np.zeros(buffer.shape, dtype=bool)
+
+    offsets = [(dy * stride + dx, np.float32(weight)) for dy, dx, weight in kernel]
+    rows = np.arange(h)
+
+    for t in range(w + 2 * (h - 1)):
+        # Every (y, x) where x + 2y == t
+        y = rows[max(0, (t - w + 2) // 2):min(h - 1, t // 2) + 1]
+        index = y * (stride - 2) + (t + 2)
+
+        old = buffer[index]
+        dots = old < 128
+        black[index] = dots
+        error = np.where(dots, old, old - 255)
+
+        for offset, weight in offsets:
+            buffer[index + offset] += error * weight
+
+    return black.reshape(h + 2, stride)[:h, 2:w + 2]
+
+
+def floyd_steinberg(gray: np.ndarray) -> np.ndarray:
+    return _diffuse(gray, FLOYD_STEINBERG)
+
+
+def atkinson(gray: np.ndarray) -> np.ndarray:
+    return _diffuse(gray, ATKINSON)
+
+
+ALGORITHMS = {
+    "threshold": threshold,
+    "bayer": bayer,
+    "floyd-steinberg": floyd_steinberg,
+    "atkinson": atkinson,
+}
+
+
+def dither(image: Image.Image, algorithm="atkinson", gamma=1.0, width=PRINTER_WIDTH) -> Image.Image:
+    """
+    Gets a photo ready for the thermal printer.
+
+    The photo is scaled to the width of the paper, gamma corrected
+    and then dithered down to black and white.
+
+    Thermal paper tends to print dark, a gamma above 1 brightens the
+    midtones to make up for it.
+
+    :param image: Any Pillow image
+    :param algorithm: One of ALGORITHMS
+    :param gamma: Gamma correction applied before dithering
+    :param width: Width of the result in dots
+    :return: A "1" mode image, ready for raster.pack()
+    """
+    try:
+        algorithm = ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError(f"Unknown dithering algorithm: {algorithm}")
+
+    gray = fit(image, width)
+
+    if gamma != 1.0:
+        lut = [round(255 * (level / 255) ** (1 / gamma)) for level in range(256)]
+        gray = gray.point(lut)
+
+    black = algorithm(np.asarray(gray, dtype=np.float32))
+
+    # Pillow's "1" mode is True for white
+    return Image.fromarray(~black)
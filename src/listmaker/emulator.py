@@ -0,0 +1,502 @@
+from PIL import Image, ImageDraw, ImageFont
+from escpos.escpos import Escpos
+from dataclasses import dataclass
+import argparse
+import numpy as np
+import os
+import sys
+import time
+
+# TM-T88V numbers from the technical reference guide
+DOTS_PER_MM = 180 / 25.4
+# Fastest it feeds paper, graphics heavy jobs print slower on a real printer
+PRINT_SPEED = 300
+# Roughly what a USB full-speed bulk endpoint manages in bytes per second
+USB_BANDWIDTH = 1_000_000
+PAPER_WIDTH = 512
+
+# Font A is 12x24 dots, font B is 9x17
+FONTS = ((12, 24), (9, 17))
+# ESC 2, 1/6 inch
+DEFAULT_LINE_SPACING = 30
+
+ESC, GS, LF = 0x1b, 0x1d, 0x0a
+
+# How long ESC and GS commands are (including ESC/GS itself) for the ones
+# that don't change anything we care about, so they can be skipped over
+SKIP = {
+    (ESC, ord("t")): 3, (ESC, ord("M")): 3, (ESC, ord("-")): 3, (ESC, ord("G")): 3,
+    (ESC, ord(" ")): 3, (ESC, ord("R")): 3, (ESC, ord("{")): 3, (ESC, ord("V")): 3,
+    (ESC, ord("c")): 4, (ESC, ord("p")): 5, (ESC, ord("$")): 4, (ESC, ord("\\")): 4,
+    (GS, ord("B")): 3, (GS, ord("H")): 3, (GS, ord("f")): 3, (GS, ord("h")): 3,
+    (GS, ord("w")): 3, (GS, ord("a")): 3, (GS, ord("L")): 4, (GS, ord("W")): 4,
+    (GS, ord("P")): 4,
+}
+
+# Commands with one parameter that change how things get printed, see _setting()
+SETTINGS = {(ESC, ord(c)) for c in "JdaE!3%"} | {(GS, ord("!"))}
+
+# Text is in PC437, the code page the printer starts with
+CODE_PAGE = "cp437"
+
+
+@dataclass
+class EmulatorStats:
+    """
+    What the emulator has printed so far.
+
+    transfer_time and print_time are how long the USB link and the print
+    head would have been busy. They overlap on a real printer, which keeps
+    printing while more data comes in, so modelled_time is the time the
+    whole thing would have taken.
+    """
+    bytes: int = 0
+    receipts: int = 0
+    dot_lines: int = 0
+    transfer_time: float = 0
+    print_time: float = 0
+    modelled_time: float = 0
+
+    @property
+    def paper_mm(self):
+        return self.dot_lines / DOTS_PER_MM
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.modelled_time if self.modelled_time else 0
+
+    def __str__(self):
+        return (
+            f"{self.bytes} bytes, {self.receipts} receipts, {self.paper_mm:.0f}mm of paper, "
+            f"{self.modelled_time:.2f}s modelled (USB {self.transfer_time:.2f}s, printing {self.print_time:.2f}s), "
+            f"{self.bytes_per_sec / 1000:.1f} kB/s"
+        )
+
+
+class Emulator(Escpos):
+    def __init__(self, directory=None, realtime=True, bandwidth=USB_BANDWIDTH, speed=PRINT_SPEED, log=True):
+        """
+        A pretend TM-T88V that can be used anywhere a python-escpos printer can.
+
+        Everything sent to it is decoded back into what the printer would
+        have put on paper: raster images (GS v 0 and GS ( L), text (with
+        user-defined characters), paper
+        feeds and cuts. Every cut finishes a receipt, which is kept in
+        receipts and saved as a PNG if there's a directory to save it in.
+
+        It also works out how long a real printer would have needed, from
+        how fast USB moves the bytes and how fast paper comes out. With
+        realtime on, sending blocks for that long too, like a real printer
+        with a full receive buffer. That makes it usable for load testing
+        the spooler. Turn it off to decode as fast as possible.
+
+        :param directory: Where to save receipts, None to only keep them in memory
+        :param realtime: Make sending take as long as the real printer would
+        :param bandwidth: USB bytes per second
+        :param speed: Paper feed speed in mm per second
+        :param log: Print the stats every time a receipt is finished
+        """
+        super().__init__(profile="TM-T88V")
+
+        self.directory = directory
+        self.realtime = realtime
+        self.bandwidth = bandwidth
+        self.speed = speed
+        self.log = log
+
+        self.receipts = []
+        self.stats = EmulatorStats()
+
+        self._buffer = bytearray()
+        self._bands = []
+        self._line = []
+        self._graphics = None
+        self._warned = set()
+        self._fonts = {}
+
+        # When the USB link and the print head are free again, in
+        # time.monotonic() seconds, or counting from 0 if not realtime
+        self._transfer_clock = 0
+        self._print_clock = 0
+
+        self._reset()
+
+    def open(self):
+        pass
+
+    def close(self):
+        """
+        Anything that was printed but never cut still becomes a receipt
+        """
+        self._flush_line()
+
+        if self._bands:
+            self._finish_receipt()
+
+    def _raw(self, msg):
+        now = time.monotonic() if self.realtime else max(self._transfer_clock, self._print_clock)
+        busy_until = max(self._transfer_clock, self._print_clock)
+
+        # The printer sat idle since the last write
+        if now > busy_until:
+            self._transfer_clock = self._print_clock = now
+
+        self.stats.bytes += len(msg)
+        self._buffer += msg
+        self._parse()
+
+        finished = max(self._transfer_clock, self._print_clock)
+        self.stats.modelled_time += finished - max(busy_until, now)
+
+        if self.realtime:
+            time.sleep(max(0, finished - time.monotonic()))
+
+    def _reset(self):
+        """
+        ESC @, back to the power on settings
+        """
+        self._line = []
+        self._justify = 0
+        self._bold = False
+        self._font_b = False
+        self._width = 1
+        self._height = 1
+        self._line_spacing = DEFAULT_LINE_SPACING
+        self._user = False
+        self._user_chars = {}
+
+    def _transfer(self, length):
+        seconds = length / self.bandwidth
+        self._transfer_clock += seconds
+        self.stats.transfer_time += seconds
+
+    def _feed(self, band):
+        """
+        Puts a band of dots (a 2D bool array, True is black) on the paper.
+        It can only print once all of its data has come in.
+        """
+        seconds = len(band) / (self.speed * DOTS_PER_MM)
+        self._print_clock = max(self._print_clock, self._transfer_clock) + seconds
+
+        self.stats.print_time += seconds
+        self.stats.dot_lines += len(band)
+        self._bands.append(band)
+
+    def _parse(self):
+        data = self._buffer
+        position = 0
+
+        while position < len(data):
+            length = self._length(data, position)
+
+            if length is None:
+                # The rest of the command hasn't been sent yet
+                break
+
+            # The printer only acts on a command once all of it came in
+            self._transfer(length)
+            self._run(data[position:position + length])
+            position += length
+
+        del data[:position]
+
+    def _length(self, data, i):
+        """
+        How many bytes the command at data[i] takes up,
+        or None if it's cut off
+        """
+        available = len(data) - i
+        byte = data[i]
+
+        if byte not in (ESC, GS):
+            return 1
+
+        if available < 2:
+            return None
+
+        command = (byte, data[i + 1])
+
+        if command in ((ESC, ord("@")), (ESC, ord("2"))):
+            length = 2
+        elif command == (GS, ord("V")):
+            # GS V m, or GS V m n for the cuts that feed first
+            length = 4 if available >= 3 and data[i + 2] in (65, 66) else 3
+        elif command == (GS, ord("v")):
+            # GS v 0 m xL xH yL yH [data], x in bytes, y in dots
+            if available < 8:
+                return None
+
+            length = 8 + (data[i + 4] | data[i + 5] << 8) * (data[i + 6] | data[i + 7] << 8)
+        elif command == (ESC, ord("&")):
+            # ESC & y c1 c2, then x [y * x bytes] for every character from c1 to c2
+            if available < 5:
+                return None
+
+            height = data[i + 2]
+            length = 5
+
+            for _ in range(data[i + 4] - data[i + 3] + 1):
+                if available <= length:
+                    return None
+
+                length += 1 + height * data[i + length]
+        elif command == (GS, ord("(")):
+            # GS ( fn pL pH [pL + pH * 256 bytes]
+            if available < 5:
+                return None
+
+            length = 5 + (data[i + 3] | data[i + 4] << 8)
+        elif command in SKIP:
+            length = SKIP[command]
+        elif command in SETTINGS:
+            length = 3
+        else:
+            # No way to know how long it is, so only the command itself is skipped
+            length = 2
+
+        return length if available >= length else None
+
+    def _run(self, command):
+        byte = command[0]
+
+        if byte == LF:
+            self._print_line(self._line_spacing)
+        elif byte not in (ESC, GS):
+            if byte >= 0x20:
+                char = self._user_chars.get(byte) if self._user else None
+                char = bytes([byte]).decode(CODE_PAGE) if char is None else char
+                self._line.append((char, self._bold, self._font_b, self._width, self._height))
+        elif command[:2] == b"\x1b@":
+            self._reset()
+        elif command[:2] == b"\x1b2":
+            self._line_spacing = DEFAULT_LINE_SPACING
+        elif command[:2] == b"\x1dV":
+            # Full or partial cut, the ones with n feed n dots first
+            self._print_line(command[3] if len(command) == 4 else 0)
+            self._finish_receipt()
+        elif command[:2] == b"\x1dv":
+            width_bytes = command[4] | command[5] << 8
+            height = command[6] | command[7] << 8
+            self._flush_line()
+            self._raster(command[8:], width_bytes, height, width_bytes * 8)
+        elif command[:2] == b"\x1b&":
+            self._define(command)
+        elif command[:3] == b"\x1d(L":
+            self._graphics_command(command[5:])
+        elif (byte, command[1]) in SETTINGS:
+            self._setting((byte, command[1]), command[2])
+        elif (byte, command[1]) not in SKIP and bytes(command[:2]) not in self._warned:
+            print(f"Emulator: don't know {bytes(command[:2])!r}, skipping it")
+            self._warned.add(bytes(command[:2]))
+
+    def _setting(self, command, n):
+        match command:
+            case (0x1b, 0x4a):  # ESC J, feed n dots
+                self._print_line(n)
+            case (0x1b, 0x64):  # ESC d, feed n lines
+                self._print_line(self._line_spacing * n)
+            case (0x1b, 0x61):  # ESC a, justification
+                self._justify = n % 48
+            case (0x1b, 0x45):  # ESC E, emphasized
+                self._bold = bool(n & 1)
+            case (0x1b, 0x21):  # ESC !, print mode
+                self._font_b = bool(n & 1)
+                self._bold = bool(n & 8)
+                self._height = 2 if n & 16 else 1
+                self._width = 2 if n & 32 else 1
+            case (0x1b, 0x33):  # ESC 3, line spacing in dots
+                self._line_spacing = n
+            case (0x1b, 0x25):  # ESC %, user-defined characters on or off
+                self._user = bool(n & 1)
+            case (0x1d, 0x21):  # GS !, character size
+                self._width = (n >> 4 & 7) + 1
+                self._height = (n & 7) + 1
+
+    def _define(self, command):
+        """
+        ESC & y c1 c2 [x d1...d(y * x)]..., user-defined characters.
+        Each one is sent column by column, y bytes per column, top dot first.
+        """
+        height, first, last = command[2], command[3], command[4]
+        position = 5
+
+        for code in range(first, last + 1):
+            width = command[position]
+            data = np.frombuffer(bytes(command[position + 1:position + 1 + height * width]), dtype=np.uint8)
+            position += 1 + height * width
+
+            columns = np.unpackbits(data.reshape(width, height), axis=1)
+            self._user_chars[code] = columns.T.astype(bool)
+
+    def _graphics_command(self, body):
+        # m fn [parameters], m is always 48
+        if len(body) < 2:
+            return
+
+        fn = body[1]
+
+        if fn == ord("p") and len(body) >= 10:
+            # a bx by c xL xH yL yH [data], store it
+            scale_x, scale_y = body[3], body[4]
+            width = body[6] | body[7] << 8
+            height = body[8] | body[9] << 8
+            self._graphics = (bytes(body[10:]), width, height, scale_x, scale_y)
+        elif fn == ord("2") and self._graphics:
+            # Print what was stored
+            data, width, height, scale_x, scale_y = self._graphics
+            self._flush_line()
+            self._raster(data, (width + 7) // 8, height, width, scale_x, scale_y)
+
+    def _raster(self, data, width_bytes, height, width, scale_x=1, scale_y=1):
+        rows = np.frombuffer(bytes(data), dtype=np.uint8)[:width_bytes * height]
+        rows = rows.reshape(height, width_bytes)
+        dots = np.unpackbits(rows, axis=1)[:, :width].astype(bool)
+
+        if scale_x > 1 or scale_y > 1:
+            dots = dots.repeat(scale_y, axis=0).repeat(scale_x, axis=1)
+
+        self._feed(self._place(dots))
+
+    def _place(self, dots):
+        """
+        Puts dots on a full paper width band, lined up with ESC a
+        """
+        band = np.zeros((len(dots), PAPER_WIDTH), dtype=bool)
+        dots = dots[:, :PAPER_WIDTH]
+        x = (PAPER_WIDTH - dots.shape[1]) * self._justify // 2
+        band[:, x:x + dots.shape[1]] = dots
+
+        return band
+
+    def _flush_line(self):
+        """
+        Text that's still waiting for a line feed gets printed, same as
+        the printer does before a raster image or a cut
+        """
+        if self._line:
+            self._print_line(self._line_spacing)
+
+    def _print_line(self, spacing):
+        """
+        Prints the text on the current line and moves the paper
+        spacing dots, or as far as the tallest character needs
+        """
+        if not self._line:
+            if spacing:
+                self._feed(np.zeros((spacing, PAPER_WIDTH), dtype=bool))
+            return
+
+        cells = [self._character(*character) for character in self._line]
+        self._line = []
+
+        height = max(cell.shape[0] for cell in cells)
+        line = np.zeros((max(height, spacing), sum(cell.shape[1] for cell in cells)), dtype=bool)
+        x = 0
+
+        for cell in cells:
+            # Characters of different sizes share the same baseline
+            line[height - cell.shape[0]:height, x:x + cell.shape[1]] = cell
+            x += cell.shape[1]
+
+        self._feed(self._place(line))
+
+    def _character(self, char, bold, font_b, width, height):
+        cell_width, cell_height = FONTS[font_b]
+
+        if isinstance(char, np.ndarray):
+            # User-defined, already in dots
+            cell = np.zeros((cell_height, cell_width), dtype=bool)
+            cell[:char.shape[0], :char.shape[1]] = char[:cell_height, :cell_width]
+            return cell.repeat(height, axis=0).repeat(width, axis=1)
+
+        if char in "─━═":
+            # The stand-in font has no box drawing, the printer's joins them up into a rule
+            cell = np.zeros((cell_height * height, cell_width * width), dtype=bool)
+            middle = cell_height * height // 2
+            cell[middle - 1:middle + 1] = True
+            return cell
+
+        font = self._fonts.get(font_b)
+
+        if font is None:
+            # Pillow's built-in font stands in for the printer's
+            font = ImageFont.load_default(size=round(cell_height * 5 / 6))
+            self._fonts[font_b] = font
+
+        # The stand-in font is wider than the printer's, so every character is
+        # squeezed by the same amount, just enough for the widest one to fit,
+        # and centred in its cell. Narrow ones stay narrow, like on paper.
+        scale = min(1, cell_width / font.getlength("M"))
+        advance = max(1, font.getlength(char) + bold)
+
+        image = Image.new("L", (int(advance) + 1, cell_height), 0)
+        draw = ImageDraw.Draw(image)
+        draw.text((0, 1), char, fill=255, font=font)
+
+        if bold:
+            draw.text((1, 1), char, fill=255, font=font)
+
+        image = image.resize((max(1, round(advance * scale)), cell_height), box=(0, 0, advance, cell_height))
+        cell = Image.new("L", (cell_width, cell_height), 0)
+        cell.paste(image, ((cell_width - image.width) // 2, 0))
+
+        # Double width and height print every dot twice
+        return (np.asarray(cell) > 96).repeat(height, axis=0).repeat(width, axis=1)
+
+    def _finish_receipt(self):
+        if not self._bands:
+            return
+
+        dots = np.concatenate(self._bands)
+        self._bands = []
+
+        receipt = Image.fromarray(~dots)
+        self.receipts.append(receipt)
+        self.stats.receipts += 1
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            receipt.save(os.path.join(self.directory, f"receipt-{self.stats.receipts:04}.png"))
+
+        if self.log:
+            print(f"Emulator: {self.stats}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Decodes ESC/POS payloads (e.g. from batch.py --escpos) into receipt PNGs "
+                    "and models how long the TM-T88V would take to print them.",
+    )
+    parser.add_argument("payloads", nargs="+", help="Files with raw ESC/POS data")
+    parser.add_argument("-o", "--output", help="Where to save the receipts")
+    args = parser.parse_args(argv)
+
+    total = EmulatorStats()
+
+    for path in args.payloads:
+        with open(path, "rb") as file:
+            payload = file.read()
+
+        printer = Emulator(realtime=False, log=False)
+        printer._raw(payload)
+        printer.close()
+
+        name = os.path.splitext(os.path.basename(path))[0]
+
+        for index, receipt in enumerate(printer.receipts):
+            if args.output:
+                os.makedirs(args.output, exist_ok=True)
+                suffix = f"-{index + 1}" if len(printer.receipts) > 1 else ""
+                receipt.save(os.path.join(args.output, f"{name}{suffix}.png"))
+
+        print(f"{path}: {printer.stats}")
+
+        for field in ("bytes", "receipts", "dot_lines", "transfer_time", "print_time", "modelled_time"):
+            setattr(total, field, getattr(total, field) + getattr(printer.stats, field))
+
+    if len(args.payloads) > 1:
+        print(f"Total: {total}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+import os
+import threading
+
+
+@contextmanager
+def replace(path, mode="wb"):
+    """
+    Opens a file to write path with. It's written next to path first and
+    swapped in once the with block is done, so nothing that reads path
+    (other threads, other processes, the next run) ever sees half a file.
+    If the block raises, path stays as it was.
+
+        with replace(path) as file:
+            file.write(data)
+    """
+    # Unique per thread, so two writers never share a temp file
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        with open(temp, mode) as file:
+            yield file
+
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+
+def font_stamp(font) -> str:
+    """
+    Identifies the exact font file a FreeTypeFont was loaded from, so
+    anything cached from it isn't used anymore once the font changes
+    """
+    stat = os.stat(font.path)
+    return f"{font.path}:{font.size}:{stat.st_size}:{stat.st_mtime_ns}"
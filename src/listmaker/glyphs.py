@@ -0,0 +1,237 @@
+from PIL import Image, ImageDraw, ImageFont
+from dataclasses import dataclass
+import appdirs
+import numpy as np
+import os
+
+from files import font_stamp, replace
+
+# Characters that get rasterized up front, everything else is added as it's used
+CHARSET = "".join(chr(code) for code in range(32, 127)) + "\u2022\u25A2\u2b62\u27a4\u2023"
+
+
+@dataclass
+class Glyph:
+    """
+    A single rasterized character.
+
+    mask is the ink coverage, 0-255 for "L" and True/False for "1".
+    left and top are where the mask goes relative to the pen position
+    (same as font.getbbox()), advance is how far the pen moves afterwards.
+
+    cell is the glyph placed in a box one line tall and one advance wide.
+    Iosevka is monospaced, so a whole line is just its cells side by side.
+    It's None if the glyph doesn't fit in its box.
+    """
+    mask: np.ndarray
+    left: int
+    top: int
+    advance: float
+    cell: np.ndarray = None
+
+
+class GlyphAtlas:
+    def __init__(self, font: ImageFont.FreeTypeFont, mode="L", cache_dir=None):
+        """
+        Every character of a font rasterized once by FreeType and then
+        copied into the image with NumPy, instead of asking FreeType to
+        render every line from scratch.
+
+        The list only ever uses two fonts at fixed sizes, so there are only a
+        few hundred glyphs to keep around.
+
+        The atlas can be saved to cache_dir so the next start can skip
+        rasterizing. It's rebuilt if the font file changes.
+
+        :param font: The font to rasterize
+        :param mode: "L" for anti-aliased glyphs, "1" for 1-bit glyphs
+        :param cache_dir: Where to save the atlas, None to keep it in memory
+        """
+        self.font = font
+        self.mode = mode
+        self.glyphs = {}
+        self._blanks = {}
+
+        ascent, descent = font.getmetrics()
+        self.line_height = ascent + descent
+        self.path = None
+        self._dirty = False
+
+        if cache_dir:
+            name = os.path.splitext(os.path.basename(font.path))[0]
+            self.path = os.path.join(cache_dir, f"{name}-{font.size}-{mode}.npz")
+
+        if not self._load():
+            for char in CHARSET:
+                self.glyph(char)
+
+    def glyph(self, char) -> Glyph:
+        glyph = self.glyphs.get(char)
+
+        if glyph is None:
+            glyph = self._rasterize(char)
+            self._add(char, glyph)
+            self._dirty = True
+
+        return glyph
+
+    def getlength(self, text) -> float:
+        """
+        Same as font.getlength(), from the stored advances
+        """
+        return sum(self.glyph(char).advance for char in text)
+
+    def getbottom(self, text) -> int:
+        """
+        Same as font.getbbox(text)[3], the lowest pixel with any ink
+        """
+        return max((g.top + g.mask.shape[0] for g in map(self.glyph, text) if g.mask.size), default=0)
+
+    def draw(self, canvas: np.ndarray, xy, text, ink) -> None:
+        """
+        Copies a line of text into the canvas, a 2D array of the same mode.
+        Works like ImageDraw.text() with the default "la" anchor.
+        """
+        x, y = round(xy[0]), round(xy[1])
+        glyphs = [self.glyph(char) for char in text]
+
+        if not glyphs:
+            return
+
+        if all(glyph.advance == int(glyph.advance) for glyph in glyphs):
+            # The whole line in one go. Glyphs that stick out of their cell
+            # leave a gap in the line and get drawn on their own afterwards.
+            line = np.concatenate([self._cell(glyph) for glyph in glyphs], axis=1)
+            self._blit(canvas, line, x, y, ink)
+
+            pen = x
+            for glyph in glyphs:
+                if glyph.cell is None and glyph.mask.size:
+                    self._blit(canvas, glyph.mask, pen + glyph.left, y + glyph.top, ink)
+                pen += int(glyph.advance)
+
+            return
+
+        pen = xy[0]
+        for glyph in glyphs:
+            self._blit(canvas, glyph.mask, round(pen) + glyph.left, y + glyph.top, ink)
+            pen += glyph.advance
+
+    def _cell(self, glyph):
+        if glyph.cell is not None:
+            return glyph.cell
+
+        blank = self._blanks.get(glyph.advance)
+
+        if blank is None:
+            blank = np.zeros((self.line_height, int(glyph.advance)), dtype=bool if self.mode == "1" else np.uint8)
+            self._blanks[glyph.advance] = blank
+
+        return blank
+
+    def _blit(self, canvas, mask, x0, y0, ink):
+        height, width = canvas.shape
+
+        # Clip the mask to the canvas
+        top, left = max(0, -y0), max(0, -x0)
+        bottom = min(mask.shape[0], height - y0)
+        right = min(mask.shape[1], width - x0)
+
+        if bottom <= top or right <= left:
+            return
+
+        mask = mask[top:bottom, left:right]
+        region = canvas[y0 + top:y0 + bottom, x0 + left:x0 + right]
+
+        if self.mode == "1":
+            region[mask] = ink
+        else:
+            # Blend the ink in by how much of the pixel the glyph covers
+            coverage = mask.astype(np.uint32)
+            blended = (ink * coverage + region * (255 - coverage) + 127) // 255
+            region[...] = blended
+
+    def save(self) -> None:
+        """
+        Writes the atlas to disk if there's anything new in it
+        """
+        if not self.path or not self._dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        chars = list(self.glyphs)
+        glyphs = [self.glyphs[char] for char in chars]
+
+        # Other processes (see batch.py) never load a half-written atlas
+        with replace(self.path) as file:
+            np.savez(
+                file,
+                font=font_stamp(self.font),
+                chars=np.array([ord(char) for char in chars]),
+                boxes=np.array([(g.left, g.top, g.mask.shape[1], g.mask.shape[0]) for g in glyphs]).reshape(-1, 4),
+                advances=np.array([g.advance for g in glyphs]),
+                masks=np.concatenate([g.mask.ravel() for g in glyphs]) if glyphs else np.array([]),
+            )
+
+        self._dirty = False
+
+    def _load(self) -> bool:
+        if not self.path or not os.path.exists(self.path):
+            return False
+
+        try:
+            with np.load(self.path) as saved:
+                if str(saved["font"]) != font_stamp(self.font):
+                    return False
+
+                masks = saved["masks"]
+                start = 0
+
+                for code, (left, top, w, h), advance in zip(saved["chars"], saved["boxes"], saved["advances"]):
+                    mask = masks[start:start + w * h].reshape(h, w)
+                    start += w * h
+                    self._add(chr(code), Glyph(mask, int(left), int(top), float(advance)))
+        except (OSError, KeyError, ValueError):
+            # A broken cache file just means rasterizing again
+            self.glyphs = {}
+            return False
+
+        return True
+
+    def _add(self, char, glyph):
+        h, w = glyph.mask.shape
+        advance = glyph.advance
+
+        fits = (
+            advance == int(advance)
+            and glyph.left >= 0 and glyph.left + w <= advance
+            and glyph.top >= 0 and glyph.top + h <= self.line_height
+        )
+
+        if fits:
+            glyph.cell = np.zeros((self.line_height, int(advance)), dtype=glyph.mask.dtype)
+            glyph.cell[glyph.top:glyph.top + h, glyph.left:glyph.left + w] = glyph.mask
+
+        self.glyphs[char] = glyph
+
+    def _rasterize(self, char) -> Glyph:
+        left, top, right, bottom = self.font.getbbox(char)
+        advance = self.font.getlength(char)
+
+        # Spaces and other blank characters only move the pen
+        if right <= left or bottom <= top:
+            empty = np.zeros((0, 0), dtype=bool if self.mode == "1" else np.uint8)
+            return Glyph(empty, 0, 0, advance)
+
+        image = Image.new(self.mode, (right - left, bottom - top), 0)
+        ImageDraw.Draw(image).text((-left, -top), char, fill=255 if self.mode == "L" else 1, font=self.font)
+
+        return Glyph(np.asarray(image).copy(), left, top, advance)
+
+
+def cache_dir():
+    """
+    Default place to keep saved atlases, e.g. ~/.cache/listmaker on Linux
+    """
+    return appdirs.user_cache_dir("listmaker")
@@ -1,7 +1,10 @@
 import os
-from PIL import Image, UnidentifiedImageError
+from PIL import ImageTk
 
 from image import ListImage
+from textlist import TextList
+from rendercache import RenderCache
+from spooler import PrinterPool
 
 # For making the GUI
 import ttkbootstrap as ttk
@@ -9,11 +12,18 @@ from ttkbootstrap.constants import *
 from ttkbootstrap.style import Style
 from ttkbootstrap.dialogs.dialogs import Messagebox
 from functools import partial
+from dataclasses import dataclass
+from tkinter import TclError, filedialog
 
-# For Printing
-from escpos.printer import Usb
-from escpos.exceptions import Error
-import traceback
+# Milliseconds to wait after the last change before redrawing the preview
+PREVIEW_DELAY = 300
+
+# "image" prints the list as drawn in the preview, "text" prints it
+# in the printer's own font, which is much less to send (see textlist.py)
+LIST_MODE = os.environ.get("LIST_MODE") or "image"
+
+# Where rendered lists are saved between runs, leave it empty to only keep them in memory
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR") or None
 
 
 class MainApplication(ttk.Frame):
@@ -27,7 +37,7 @@ class MainApplication(ttk.Frame):
         self.has_separators = ttk.BooleanVar(value=False)
         # End settings
 
-        # Keeps track of all entries
+        # Keeps track of all entries, as plain strings
         self.entries = []
 
         # Keeps track of notes section
@@ -37,6 +47,19 @@ class MainApplication(ttk.Frame):
 
         # The image with the list for printing
         self.list_image = ListImage()
+        self.text_list = TextList()
+
+        # Lists that were already rendered, so Preview, Save Image and
+        # Submit (and printing it again) only draw a list once
+        self.render_cache = RenderCache(self.list_image, self.text_list, directory=RENDER_CACHE_DIR)
+
+        # Prints in the background so the window doesn't freeze
+        self.spooler = PrinterPool()
+
+        # Keeps track of the live preview
+        self.preview_canvas = None
+        self.preview_photo = None
+        self.preview_job = None
 
         # Add trash icon to delete button in entries
         trash_png_path = os.path.join(os.getcwd(), "assets", "trash.png")
@@ -54,13 +77,18 @@ class MainApplication(ttk.Frame):
             self.show_notes,
         )
         self.list_entries = ListItems(
-            self.master, self.entries, self.trash_icon, self.trash_hover_icon
+            self.master, self.entries, self.trash_icon, self.trash_hover_icon, self.schedule_preview
         )
 
         self.list_customization.grid(row=0, column=0, padx=15, pady=15, sticky=NSEW)
         self.list_entries.grid(row=1, column=0, padx=15, pady=15, sticky=NSEW)
         self.show_notes()
         self.create_buttonbox()
+        self.create_preview()
+
+        # Redraw the preview whenever a setting changes
+        for variable in (self.title, self.list_type, self.has_notes, self.has_separators):
+            variable.trace_add("write", self.schedule_preview)
 
     def show_notes(self):
         if not self.has_notes.get():
@@ -80,10 +108,11 @@ class MainApplication(ttk.Frame):
 
         self.notes_box = ttk.Text(master=self.notes_frame, wrap="word", height=1)
         self.notes_box.pack(side=BOTTOM, padx=5, pady=10, fill=BOTH, expand=YES)
+        self.notes_box.bind("<KeyRelease>", self.schedule_preview)
 
     def create_buttonbox(self):
         container = ttk.Frame(self.master, bootstyle=DARK)
-        container.grid(row=2, column=0, columnspan=2, sticky="nsew")
+        container.grid(row=2, column=0, columnspan=3, sticky="nsew")
 
         # White text on light green makes it hard to read the button text.
         # This changes the foreground to black
@@ -120,6 +149,51 @@ class MainApplication(ttk.Frame):
         )
         save_btn.pack(side=LEFT, padx=15)
 
+    def create_preview(self):
+        frame = ttk.Labelframe(self.master, text="Preview", padding=(10, 10))
+        frame.grid(row=0, rowspan=2, column=2, sticky="nsew", padx=15, pady=15)
+
+        # Previews are shown at half size, so 512px images are 256px wide
+        self.preview_canvas = ttk.Canvas(frame, width=256)
+        self.preview_canvas.pack(side=LEFT, fill=Y, expand=YES)
+
+        scrollbar = ttk.Scrollbar(frame, orient=VERTICAL, command=self.preview_canvas.yview)
+        scrollbar.pack(side=RIGHT, fill="y")
+
+        self.preview_canvas.configure(yscrollcommand=scrollbar.set)
+        self.schedule_preview()
+
+    def schedule_preview(self, *args):
+        """
+        Redraws the preview once typing stops for PREVIEW_DELAY ms.
+        Every change pushes the redraw back, so a burst of keystrokes
+        only redraws once.
+        """
+        if self.preview_job:
+            self.after_cancel(self.preview_job)
+
+        self.preview_job = self.after(PREVIEW_DELAY, self.update_preview)
+
+    def update_preview(self):
+        """
+        ListImage keeps every block of the list it has drawn, so
+        this only redraws the blocks that changed
+        """
+        self.preview_job = None
+        self.preview_canvas.delete("all")
+
+        try:
+            image = self.render_cache.image(self.get_settings(), disk=False)
+        except TypeError:
+            # Nothing entered yet
+            return
+
+        preview = image.reduce(2)
+        self.preview_photo = ImageTk.PhotoImage(preview)
+
+        self.preview_canvas.create_image(0, 0, image=self.preview_photo, anchor="nw")
+        self.preview_canvas.configure(scrollregion=(0, 0, preview.width, preview.height))
+
     def get_settings(self):
         if self.has_notes.get():
             self.notes = self.notes_box.get("1.0", "end-1c")
@@ -131,7 +205,7 @@ class MainApplication(ttk.Frame):
             "has_separators": self.has_separators.get(),
         }
 
-        all_entries = [entry.get() for entry in self.entries]
+        all_entries = list(self.entries)
         # Removes all entries that are only whitespace
         text_entries = list(filter(lambda entry: entry.strip(), all_entries))
         options["entries"] = text_entries
@@ -139,35 +213,26 @@ class MainApplication(ttk.Frame):
         if self.has_notes.get():
             options["notes"] = self.notes
 
-        print(options)
-
         return options
 
     def print_image_list(self):
         options = self.get_settings()
-        list_image = self.construct_image(options)
 
-        if not list_image:
+        if self.list_image.is_empty(options):
+            Messagebox.show_error(message="The image is empty. Did you enter any data?", title="Empty Image")
             return
 
         """
-        Tells the printer to print the image
+        Hands the list to the spooler which prints it in the background,
+        band by band as it's drawn, so the printer gets going right away
+        no matter how long the list is. Errors get printed by the spooler.
+        A list that was printed before is sent straight from the render cache.
         """
-        try:
-            printer = Usb(
-                idVendor=int(os.environ["VENDOR_ID"], 16),
-                idProduct=int(os.environ["PRODUCT_ID"], 16),
-                in_ep=int(os.environ["IN_EP"], 16),
-                out_ep=int(os.environ["OUT_EP"], 16),
-                profile="TM-T88V",
-            )
-
-            printer.image(list_image)
-            printer.cut()
+        # Only here, the live preview gets the settings on every pause in typing
+        print(options)
 
-        except Error as err:
-            traceback.print_exc()
-            print(f"ERROR {err.resultcode}: {err.msg}")
+        impl = "text" if LIST_MODE == "text" else "bitImageRaster"
+        self.spooler.submit(self.render_cache.stream(options, impl))
 
     def preview_list(self):
         options = self.get_settings()
@@ -178,17 +243,13 @@ class MainApplication(ttk.Frame):
         if image:
             image.show(title)
 
-    def construct_image(self, options):
+    def construct_image(self, options, mode=None):
         image = None
 
         try:
-            self.list_image.generate(options)
-            
-            image = Image.open(self.list_image.bytes)
+            image = self.render_cache.image(options, mode)
         except TypeError:
             Messagebox.show_error(message="The image is empty. Did you enter any data?", title="Empty Image")
-        except UnidentifiedImageError:
-            Messagebox.show_error(message="There is an issue with the image bytes.", title="UnidentifiedImageError")
 
         return image
 
@@ -290,77 +351,118 @@ class Customization(ttk.Labelframe):
         ).pack(side=RIGHT)
 
 
+@dataclass
+class EntryRow:
+    """
+    One row of widgets in ListItems. Rows get reused for
+    whichever entry is scrolled into their spot.
+    """
+    frame: ttk.Frame
+    label: ttk.Label
+    text: ttk.StringVar
+    entry: ttk.Entry
+    index: int = 0
+
+
 class ListItems(ttk.Labelframe):
-    def __init__(self, master, entries, trash, trash_hover):
+    def __init__(self, master, entries, trash, trash_hover, on_change, rows=8):
+        """
+        Editor for the list entries.
+
+        Only a fixed number of rows of widgets is ever made. Scrolling just
+        shows different entries in the same rows, so a list with thousands
+        of entries has as many widgets as one with eight, and adding or
+        deleting an entry only updates the rows on screen.
+
+        Enter in an entry adds a new one below it. Paste and Import add
+        one entry per line of text.
+
+        :param entries: List of strings the entries are kept in
+        :param on_change: Called whenever an entry is added, removed or edited
+        :param rows: How many entries are on screen at once
+        """
         super().__init__(master=master, text="Enter Entries", padding=(20, 0, 0))
 
         self.entries = entries
         self.trash_icon = trash
         self.trash_hover_icon = trash_hover
+        self.on_change = on_change
 
-        # The following creates the scrollbar inside the Labelframe
-        self.canvas = ttk.Canvas(self)
-        self.canvas.pack(side=LEFT, fill=Y, expand=YES)
+        # Index of the entry in the first row
+        self.top = 0
+        self.rows = []
+        # Set while rows are being filled in, so that doesn't count as an edit
+        self._loading = False
 
-        scrollbar = ttk.Scrollbar(self, orient=VERTICAL, command=self.canvas.yview)
-        scrollbar.pack(side=RIGHT, fill="y")
+        header_txt = "Entry Data"
+        header = ttk.Label(master=self, text=header_txt, width=50)
+        header.pack(fill=X, padx=5, pady=10)
 
-        self.canvas.configure(yscrollcommand=scrollbar.set)
+        body = ttk.Frame(self)
+        body.pack(fill=BOTH, expand=YES)
 
-        self.frame_inside_canvas = ttk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.frame_inside_canvas, anchor="nw")
-        self.frame_inside_canvas.bind(
-            "<Configure>",
-            lambda event, canvas=self.canvas: canvas.configure(
-                scrollregion=canvas.bbox("all")
-            ),
-        )
-        self.master.bind_all("<MouseWheel>", self.on_mousewheel)
-        # End scrollbar creation
+        self.scrollbar = ttk.Scrollbar(body, orient=VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=RIGHT, fill=Y)
 
-        header_txt = "Entry Data"
-        header = ttk.Label(master=self.frame_inside_canvas, text=header_txt, width=50)
-        header.pack(fill=X, padx=5, pady=10)
+        rows_frame = ttk.Frame(body)
+        rows_frame.pack(side=LEFT, fill=BOTH, expand=YES)
+
+        for slot in range(rows):
+            self.rows.append(self.create_row(rows_frame, slot))
+
+        # Mouse wheels are <MouseWheel> on Windows and macOS, buttons 4 and 5 on Linux
+        self.master.bind_all("<MouseWheel>", self.on_mousewheel)
+        self.master.bind_all("<Button-4>", lambda event: self.scroll(-1))
+        self.master.bind_all("<Button-5>", lambda event: self.scroll(1))
 
         # Changes foreground color to black since white on yellow is too light
         style = Style()
         style.configure("primary.TButton", foreground="#000000")
+
+        buttons = ttk.Frame(self)
+        buttons.pack(side=BOTTOM, pady=10)
+
         sub_btn = ttk.Button(
-            master=self.frame_inside_canvas,
+            master=buttons,
             text="Add Entry",
             command=self.on_add_entry,
             bootstyle=PRIMARY,
             style="primary.TButton",
         )
-        sub_btn.pack(side=BOTTOM, padx=5, pady=10)
+        sub_btn.pack(side=LEFT, padx=5)
 
-        # Create 5 form entries at the start
-        for i in range(5):
-            self.create_form_entry(i)
+        paste_btn = ttk.Button(master=buttons, text="Paste", command=self.on_paste, bootstyle=(OUTLINE, PRIMARY))
+        paste_btn.pack(side=LEFT, padx=5)
 
-    def create_form_entry(self, index, new_frame=True):
-        container = ttk.Frame(self.frame_inside_canvas)
-        container.pack(fill=X, expand=YES, pady=5)
+        import_btn = ttk.Button(master=buttons, text="Import", command=self.on_import, bootstyle=(OUTLINE, PRIMARY))
+        import_btn.pack(side=LEFT, padx=5)
 
-        try:
-            text = self.entries[index]
-        except IndexError:
-            text = ttk.StringVar(value="")
+        # Start with 5 empty entries
+        self.entries.extend([""] * 5)
+        self.refresh()
 
-        if new_frame:
-            self.entries.append(text)
+    def create_row(self, master, slot):
+        container = ttk.Frame(master)
+        container.grid(row=slot, column=0, sticky=EW, pady=5)
+        master.columnconfigure(0, weight=1)
 
-        label = ttk.Label(master=container, text=f"Entry {index + 1}", width=10)
+        label = ttk.Label(master=container, width=10)
         label.pack(side=LEFT, padx=5)
 
+        text = ttk.StringVar(value="")
         ent = ttk.Entry(master=container, textvariable=text)
         ent.pack(side=LEFT, padx=5, fill=X, expand=YES)
 
+        row = EntryRow(container, label, text, ent)
+
+        text.trace_add("write", lambda *args: self.on_edit(row))
+        ent.bind("<Return>", lambda event: self.on_insert(row))
+
         sub_btn = ttk.Button(
             master=container,
             image=self.trash_icon,
             compound=LEFT,
-            command=partial(self.on_delete, index),
+            command=partial(self.on_delete, row),
             bootstyle=(OUTLINE, DANGER),
         )
         sub_btn.pack(side=RIGHT, padx=5)
@@ -371,23 +473,135 @@ class ListItems(ttk.Labelframe):
         )
         sub_btn.bind("<Leave>", lambda event: sub_btn.config(image=self.trash_icon))
 
+        return row
+
+    def refresh(self):
+        """
+        Shows the entries from self.top onwards in the rows
+        """
+        self.top = max(0, min(self.top, len(self.entries) - len(self.rows)))
+        self._loading = True
+
+        for slot, row in enumerate(self.rows):
+            index = self.top + slot
+
+            if index >= len(self.entries):
+                row.frame.grid_remove()
+                continue
+
+            row.index = index
+            row.label.configure(text=f"Entry {index + 1}")
+
+            if row.text.get() != self.entries[index]:
+                row.text.set(self.entries[index])
+
+            row.frame.grid()
+
+        self._loading = False
+
+        total = len(self.entries)
+
+        if total > len(self.rows):
+            self.scrollbar.set(self.top / total, (self.top + len(self.rows)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll(self, rows):
+        self.top += rows
+        self.refresh()
+
+    def scroll_to(self, index):
+        """
+        Scrolls just far enough to show the entry
+        """
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + len(self.rows):
+            self.top = index - len(self.rows) + 1
+
+        self.refresh()
+
+    def focus_entry(self, index):
+        self.scroll_to(index)
+        row = self.rows[index - self.top]
+        row.entry.focus_set()
+        row.entry.icursor(END)
+
+    def on_scroll(self, action, amount, unit=None):
+        """
+        Scrollbar command, either ("moveto", fraction) or ("scroll", n, "units" or "pages")
+        """
+        if action == "moveto":
+            self.top = round(float(amount) * len(self.entries))
+            self.refresh()
+        elif unit == "pages":
+            self.scroll(int(amount) * len(self.rows))
+        else:
+            self.scroll(int(amount))
+
     def on_mousewheel(self, event):
-        self.canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
+        self.scroll(int(-1 * (event.delta / 120)))
+
+    def on_edit(self, row):
+        if self._loading:
+            return
+
+        self.entries[row.index] = row.text.get()
+        self.on_change()
 
     def on_add_entry(self):
-        self.create_form_entry(len(self.entries))
+        self.entries.append("")
+        self.focus_entry(len(self.entries) - 1)
+        self.on_change()
+
+    def on_insert(self, row):
+        index = row.index + 1
+        self.entries.insert(index, "")
+        self.focus_entry(index)
+        self.on_change()
+
+    def on_delete(self, row):
+        self.entries.pop(row.index)
+        self.refresh()
+        self.on_change()
+
+    def add_lines(self, text):
+        """
+        Adds every line of text that isn't blank as an entry.
+        Blank entries at the end of the list get filled up first.
+        """
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+        if not lines:
+            return
 
-    def on_delete(self, index):
-        self.entries.pop(index)
+        while self.entries and not self.entries[-1].strip():
+            self.entries.pop()
 
-        # Destroy all form entry frames to update UI
-        for child in self.frame_inside_canvas.winfo_children():
-            if isinstance(child, ttk.Frame):
-                child.destroy()
+        self.entries.extend(lines)
+        self.scroll_to(len(self.entries) - 1)
+        self.on_change()
+
+    def on_paste(self):
+        try:
+            text = self.clipboard_get()
+        except TclError:
+            # Nothing on the clipboard
+            return
+
+        self.add_lines(text)
+
+    def on_import(self):
+        path = filedialog.askopenfilename(
+            title="Import Entries",
+            filetypes=[("Text files", "*.txt"), ("All files", "*")],
+        )
+
+        if not path:
+            return
 
-        # Rerender forms with updated index
-        for i in range(len(self.entries)):
-            self.create_form_entry(i, new_frame=False)
+        with open(path, encoding="utf-8") as file:
+            self.add_lines(file.read())
 
 
 if __name__ == "__main__":
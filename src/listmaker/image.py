@@ -1,10 +1,16 @@
 # For Image Creation
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+import numpy as np
 import os
-import io
-import textwrap
-import traceback
-from dataclasses import astuple, dataclass
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import astuple, dataclass, field
+
+from raster import Raster, pack
+from glyphs import GlyphAtlas, cache_dir
+from metrics import span
+from wrap import Wrapper
 
 # Unicode characters for list symbols
 BULLET_POINT = "\u2022"
@@ -13,6 +19,15 @@ ARROW = "\u2b62"
 ARROWHEAD = "\u27a4"
 TRIANGULAR_BULLET = "\u2023"
 
+# The symbol in front of each entry for every list type, "number" lists count instead
+SYMBOLS = {
+    "bullet": BULLET_POINT,
+    "checkbox": CHECKBOX,
+    "arrow": ARROW,
+    "arrowhead": ARROWHEAD,
+    "triangle": TRIANGULAR_BULLET,
+}
+
 
 @dataclass
 class ImageSettings:
@@ -22,6 +37,7 @@ class ImageSettings:
     text_color: str
     line_spacing: int
     margin: int
+    mode: str
 
     def __iter__(self):
         return iter(astuple(self))
@@ -30,20 +46,96 @@ class ImageSettings:
         return iter(getattr(self, k) for k in keys)
 
 
+@dataclass
+class TextRun:
+    x: float
+    y: float
+    text: str
+    font: ImageFont.FreeTypeFont
+
+
+@dataclass
+class Layout:
+    """
+    Everything that ends up on the image, measured but not drawn yet.
+
+    runs are lines of text, rules are the y-coordinates of separator lines
+    and bottom is the lowest pixel any of them touch.
+    """
+    y: float
+    runs: list = field(default_factory=list)
+    rules: list = field(default_factory=list)
+    bottom: float = 0
+
+    def advance(self, y_offset):
+        self.y += y_offset
+
+    def add_text(self, x, text, atlas):
+        """
+        The glyph atlas of the font doubles as its measurements,
+        which saves asking FreeType for every line
+        """
+        self.runs.append(TextRun(x, self.y, text, atlas.font))
+
+        # The glyph's bottom is relative to the anchor, so it still needs
+        # the y position added to it. Blank text has no ink to measure.
+        if text.strip():
+            self.bottom = max(self.bottom, self.y + atlas.getbottom(text))
+
+    def add_rule(self):
+        self.rules.append(self.y)
+        # Lines are 2px wide so they take up y and y + 1
+        self.bottom = max(self.bottom, self.y + 2)
+
+    def extend(self, block):
+        """
+        Adds a block that was laid out on its own (starting at y = 0)
+        to the end of this layout
+        """
+        for run in block.runs:
+            self.runs.append(TextRun(run.x, self.y + run.y, run.text, run.font))
+
+        self.rules.extend(self.y + y for y in block.rules)
+
+        if block.bottom:
+            self.bottom = max(self.bottom, self.y + block.bottom)
+
+        self.advance(block.y)
+
+
+@dataclass
+class Tile:
+    """
+    A block of the list that's already drawn.
+
+    pixels are only as tall as the ink in the block (None if there's no ink),
+    height is how far the block moves everything after it down (same as Layout.y).
+    """
+    pixels: np.ndarray
+    height: float
+    bottom: float
+
+
 class ListImage:
     def __init__(self):
         """
-        512 is the max-width of the TM-T88V
-        6000 is just a large number due to the fact
-        we can't dynamically resize the image
+        512 is the max-width of the TM-T88V.
+        height is the minimum height of the image. generate() measures
+        the list first and makes the image as tall as the content needs.
+
+        mode is the Pillow image mode we draw into. The printer only does
+        black and white, so there's no point drawing in RGBA:
+            "L" - 8-bit grayscale, anti-aliased text (good for previews)
+            "1" - 1-bit, exactly the dots the printer will print
         """
         self.settings = ImageSettings(
             width=512,
-            height=6000,
+            height=0,
             bg_color="white",
             text_color="black",
             line_spacing=30,
             margin=20,
+            mode="L",
         )
 
         # Load a font
@@ -58,84 +150,209 @@ class ListImage:
             encoding="utf-16",
         )
 
-        self.bytes = None
-        self._y_position = self.settings.margin
-        print("CHECKBOX px", self.font.getlength(CHECKBOX))
-        print("BULLET px", self.font.getlength(BULLET_POINT))
-        print("ARROW px", self.font.getlength(ARROW))
-        print("TRIANGULAR_BULLET px", self.font.getlength(TRIANGULAR_BULLET))
-        print("ARROWHEAD px", self.font.getlength(ARROWHEAD))
+        # The last image made by generate()
+        self.image = None
+
+        # Pre-rasterized fonts, one for each (font, mode).
+        # Saved in glyph_cache between runs, set it to None to keep them in memory
+        self.glyph_cache = cache_dir()
+        self._atlases = {}
+        self._wrappers = {}
+
+        # Blocks of the list that are already drawn, see tile()
+        self.tile_cache_size = 1024
+        self._tiles = OrderedDict()
 
+        # bands() can run on another thread (see gui.py) while the preview redraws
+        self._lock = threading.RLock()
 
 
-    def draw_text(self, draw: ImageDraw, text: str, max_width: int, font: ImageFont, indent_offset=" ", x_offset=0) -> None:
+    def layout_text(self, layout: Layout, text: str, max_width: int, font: ImageFont, indent_offset=" ", x_offset=0) -> None:
         """
-        Iosevka is a monospaced font which means that each font character
-        has a fixed-width (except for CHECKBOX and some other unicode characters)
+        Wraps text so no line is wider than max_width and adds the lines to the layout.
 
-        textwrap.wrap() automatically handles the hard work of wrapping text
+        Lines after the first are indented by the width of indent_offset,
+        so wrapped entries line up with the text after the symbol:
+
+            ▢ A really long entry that
+              keeps on going
+
+        An indent_offset of " " means no indent (title and notes).
         """
-        text_color = self.settings.text_color 
-        line_spacing= self.settings.line_spacing
+        line_spacing = self.settings.line_spacing
+        metrics = self.atlas(font, "L")
+        wrapper = self.wrapper(font)
+
+        indent = 0
+
+        if indent_offset != " ":
+            indent = metrics.getlength(indent_offset)
+
+        # Blank text still takes up a line
+        lines = wrapper.wrap(text, max_width, indent) or [""]
+
+        layout.add_text(x_offset, lines[0], metrics)
+        layout.advance(line_spacing)
+
+        for line in lines[1:]:
+            layout.add_text(x_offset + indent, line, metrics)
+            layout.advance(line_spacing)
 
-        txt_width = font.getlength(text)
+    def add_separator(self, layout: Layout) -> None:
+        line_spacing = self.settings.line_spacing
 
-        if txt_width < max_width:
-            draw.text(
-                    (self.settings.margin, self._y_position),
-                    text,
-                    fill=text_color,
-                    font=font,
+        # Half of an empty line space
+        layout.advance(line_spacing / 2)
+        layout.add_rule()
+        # Half of an empty line space
+        layout.advance(line_spacing / 2)
+
+    def blocks(self, options) -> list:
+        """
+        Splits the list into blocks that can be laid out and drawn on their own:
+        the title, one block for each entry (with the separator under it)
+        and the notes at the end.
+
+        A block is a tuple of everything that changes how it looks,
+        so it doubles as the key for the tile cache.
+        """
+        entries = options["entries"]
+        last = len(entries) - 1
+
+        blocks = [("title", options["title"])]
+
+        for number, entry in enumerate(entries):
+            has_separator = options["has_separators"] and number != last
+            blocks.append(("entry", entry, options["list_type"], number, has_separator))
+
+        blocks.append(("notes", options["has_notes"], options.get("notes", "")))
+
+        return blocks
+
+    def layout_block(self, block) -> Layout:
+        """
+        Lays out a single block, starting from y = 0
+        """
+        width, line_spacing, margin = self.settings["width", "line_spacing", "margin"]
+
+        layout = Layout(y=0)
+        max_width = width - (margin * 2)
+
+        match block:
+            case ("title", title):
+                self.layout_text(
+                    layout,
+                    text=f'{title}',
+                    max_width=max_width,
+                    font=self.bold_font,
+                    x_offset=margin
                 )
-            self.adjust_y_position(line_spacing)
+              
+                layout.advance(line_spacing)
+
+            case ("entry", text, list_type, number, has_separator):
+                if list_type == "number":
+                    symbol = f"{number + 1})"
+                else:
+                    symbol = SYMBOLS.get(list_type)
+
+                symbol_offset = f"{symbol} "
+                entry = f"{symbol} {text}"
+
+                self.layout_text(layout, text=entry, font=self.font, x_offset=margin, max_width=max_width, indent_offset=symbol_offset)
+
+                if has_separator:
+                    self.add_separator(layout)
+
+            case ("notes", has_notes, notes):
+                # Two empty lines
+                layout.advance(line_spacing * 2)
+
+                if has_notes:
+                    layout.add_text(margin, "Notes:", self.atlas(self.font, "L"))
+                    layout.advance(line_spacing)
+                    layout.advance(line_spacing / 2)
+                    self.layout_text(layout, text=notes, font=self.font, x_offset=margin, max_width=max_width)
+
+        return layout
+
+    def layout(self, options) -> Layout:
+        """
+        First pass of generate(). Works out where every line goes
+        without drawing anything, so we know the final height up front.
+        """
+        layout = Layout(y=self.settings.margin)
+
+        for block in self.blocks(options):
+            layout.extend(self.layout_block(block))
+
+        return layout
+
+    def tile(self, block, mode) -> Tile:
+        """
+        Draws a single block, or takes it from the cache if the exact same
+        block was drawn before. Typing in one entry only changes that one
+        block, so only that block has to be drawn again.
+        """
+        key = (block, mode, tuple(self.settings))
+        tile = self._tiles.get(key)
+
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+
+        layout = self.layout_block(block)
+        pixels = None
+
+        # Blocks without any ink (no title, notes turned off) only take up space
+        if layout.bottom:
+            pixels = np.asarray(self.draw(layout, mode, math.ceil(layout.bottom)))
+
+        tile = Tile(pixels, layout.y, layout.bottom)
+
+        self._tiles[key] = tile
+
+        while len(self._tiles) > self.tile_cache_size:
+            self._tiles.popitem(last=False)
+
+        return tile
+
+    def draw(self, layout: Layout, mode, height) -> Image.Image:
+        """
+        Second pass of generate(), draws a layout onto a new image
+        """
+        width, bg_color, text_color, margin = self.settings["width", "bg_color", "text_color", "margin"]
+
+        # Draw straight into the final mode, Pillow converts the
+        # color names to the right pixel values for "L" and "1"
+        image = Image.new(mode, (width, height), bg_color)
+
+        if mode in ("L", "1"):
+            # Text gets copied in from the glyph atlas instead of
+            # going through FreeType for every line
+            canvas = np.array(image)
+            ink = ImageColor.getcolor(text_color, mode)
+
+            for run in layout.runs:
+                self.atlas(run.font, mode).draw(canvas, (run.x, run.y), run.text, ink)
+
+            image = Image.fromarray(canvas)
+            draw = ImageDraw.Draw(image)
+
+            for atlas in self._atlases.values():
+                atlas.save()
         else:
-            indent = font.getlength(indent_offset)
-            char_count = len(indent_offset)
-            avg_char_width = indent / char_count
-            print("CHAR WIDTH", avg_char_width)
-
-            """
-            Bold Title Font = 19
-            Regular Font = 14
-
-            Checkbox + space = (29px + 14px) / 2 = 21.5
-            Bullet + space = (14px*2) / 2 = 14
-            Number + ) + space = (14px*3) / 3 = 14
-
-            We set char_width to 14 for Checkbox since
-            margin = 20
-            max_width = 512 - (margin * 2) = 472
-            472 // 14 = 33 characters (the max we can go before the text goes off image 
-                                        since wrap only accepts int)
-            """
-            char_width = avg_char_width if avg_char_width < 20 else 14
-            print(char_width)
-           
-            # Floor division so we don't accidentally go over the margin
-            lines = textwrap.wrap(text, width=int(max_width // char_width))
-            symbol_line = lines[0]
-            indent_lines = lines[1:]
-
-            if indent_offset != " ":
-                indent_str = " ".join(indent_lines)
-                indent_lines = textwrap.wrap(indent_str, width=((max_width - indent) // char_width))
-
-            draw.text((x_offset, self._y_position), symbol_line, fill=text_color, font=font)
-            self.adjust_y_position(line_spacing)
-            
-            for line in indent_lines:
-                x = x_offset
-                
-                if indent_offset != " ":
-                    x += indent
-                
-                draw.text((x, self._y_position), line, fill=text_color, font=font)
-                self.adjust_y_position(line_spacing)
-    
-    def adjust_y_position(self, y_offset):
-        self._y_position += y_offset
+            draw = ImageDraw.Draw(image)
+
+            for run in layout.runs:
+                draw.text((run.x, run.y), run.text, fill=text_color, font=run.font)
+
+        for y in layout.rules:
+            draw.line((0 + margin, y, width - margin, y), width=2, fill=text_color)
+
+        return image
 
-    def generate(self, options):
+    def generate(self, options, mode=None):
         """
         To create the image with our list, we use the ImageDraw module from Pillow.
         See: https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html
@@ -159,126 +376,185 @@ class ListImage:
                     |  |                 |  |
                     |  |                 |  |
                     |  +-----------------+  |
-                    +-----------------------+ (512, 1200)
+                    +-----------------------+ (512, height)
         
         Margin is the blank gap between the content (20 pixels on 4 sides).
         Line spacing adjusts the y-coordinates (vertical position).
+
+        This happens in two passes. layout() measures every line first, which
+        gives us the exact height of the image, then everything gets drawn
+        once onto an image of that size. No cropping needed and no limit
+        on how long the list can be.
+
+        For "L" and "1" images, every block of the list (see blocks()) is
+        drawn as its own tile and cached. The image is then put together
+        from the tiles, so only blocks that changed since the last call
+        get drawn again.
+
+        The image is kept in memory and returned as is. Nothing gets
+        encoded to PNG unless someone actually saves it to a file.
+
+        :param options: The list settings from the GUI
+        :param mode: Pillow image mode to draw into, defaults to settings.mode
+        :return: The list as a PIL.Image
         """
+        width, bg_color, margin = self.settings["width", "bg_color", "margin"]
+        mode = mode or self.settings.mode
+
+        with self._lock, span("generate", mode=mode, entries=len(options["entries"])):
+            if mode not in ("L", "1"):
+                with span("layout"):
+                    layout = self.layout(options)
+
+                if not layout.bottom:
+                    print("ERROR: Image is empty")
+                    raise TypeError
+
+                height = max(self.settings.height, math.ceil(layout.bottom) + margin)
+
+                with span("draw"):
+                    self.image = self.draw(layout, mode, height)
+
+                return self.image
+
+            # Grayscale and 1-bit images are put together from cached tiles
+            y = margin
+            bottom = 0
+            placed = []
+
+            with span("tiles"):
+                for block in self.blocks(options):
+                    tile = self.tile(block, mode)
 
-        width, height, bg_color, text_color, line_spacing, margin = self.settings
+                    if tile.bottom:
+                        bottom = max(bottom, y + tile.bottom)
+                        placed.append((round(y), tile))
 
+                    y += tile.height
+
+            if not bottom:
+                print("ERROR: Image is empty")
+                raise TypeError
+
+            height = max(self.settings.height, math.ceil(bottom) + margin)
+
+            with span("compose"):
+                canvas = np.array(Image.new(mode, (width, height), bg_color))
+
+                for top, tile in placed:
+                    # Dark ink on a light background, so the darker pixel wins
+                    # where a tile's ink hangs over into the next one
+                    rows = canvas[top:top + len(tile.pixels)]
+                    np.minimum(rows, tile.pixels[:len(rows)], out=rows)
+
+                self.image = Image.fromarray(canvas)
+
+            return self.image
+
+    def bands(self, options, band_height=256, mode="1"):
         """
-        For now, create a transparent image so that we can crop it later
-        using Image.getbbox() and Image.crop()
+        Renders the list a band at a time and yields each band as soon as
+        it's done, as a Raster band_height dots tall (the last one can be
+        shorter). Put together, the bands are the same image generate() makes.
+
+        Blocks are drawn one after another like in generate(), but rows
+        are handed out as soon as nothing further down the list can draw
+        on them anymore. The printer can start on the top of the list
+        while the rest is still being drawn, and only a band or so of the
+        image is ever in memory, no matter how long the list is.
+
+        :param options: The list settings from the GUI
+        :param band_height: How many rows of dots go in each band
+        :param mode: "1" or "L", what the bands are drawn in before packing
         """
-        image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(image)
+        if mode not in ("L", "1"):
+            raise ValueError(f"Bands can only be drawn in \"L\" or \"1\", not {mode!r}")
 
-        max_width = width - (margin * 2)
+        width, bg_color, margin = self.settings["width", "bg_color", "margin"]
+        background = np.array(Image.new(mode, (width, 1), bg_color))
 
-        # Title text
-        self.draw_text(
-            draw,
-            text=f'{options["title"]}',
-            max_width=max_width,
-            font=self.bold_font,
-            x_offset=margin
-        )
-      
-        self.adjust_y_position(line_spacing)
+        # Rows that aren't handed out yet, starting at row top of the image
+        window = background[:0]
+        top = 0
 
-        entries = options["entries"]
-        entries_count = len(entries)
-        last = entries_count - 1
-        
-        # Add entries to the image
-        if options["list_type"] == "number":
-            for number in range(entries_count):
-                symbol = f"{number + 1})"
-                symbol_offset = f"{symbol} "
-                entry = f"{symbol} {entries[number]}"
-                
-                self.draw_text(draw, text=entry, font=self.font, x_offset=margin, max_width=max_width, indent_offset=symbol_offset)
+        y = margin
+        bottom = 0
 
-                if options["has_separators"]:
-                    if number != last:
-                        # Half of an empty line space
-                        self.adjust_y_position(line_spacing / 2)
+        def finished(end):
+            # Only rows inside the final image count, which can't be shorter than this
+            return min(end, max(self.settings.height, math.ceil(bottom) + margin))
 
-                        draw.line(
-                            (0 + margin, self._y_position, width - margin, self._y_position), width=2, fill="black"
-                        )
+        def grow(rows):
+            # Blank space between blocks only gets added once something needs it
+            nonlocal window
 
-                        # Half of an empty line space
-                        self.adjust_y_position(line_spacing / 2)
-        else:
-            list_type = None
-
-            match options["list_type"]:
-                case "bullet":
-                    list_type = BULLET_POINT
-                case "checkbox":
-                    list_type = CHECKBOX
-                case "arrow":
-                    list_type = ARROW
-                case "arrowhead":
-                    list_type = ARROWHEAD
-                case "triangle":
-                    list_type = TRIANGULAR_BULLET
-                
-
-            for number in range(entries_count):
-                entry = f"{list_type} {entries[number]}"
-                symbol_offset = f"{list_type} "
-                self.draw_text(draw, text=entry, font=self.font, x_offset=margin, max_width=max_width, indent_offset=symbol_offset)
-
-                if options["has_separators"]:
-                    if number != last:
-                        # Half of an empty line space
-                        self.adjust_y_position(line_spacing / 2)
-
-                        draw.line(
-                            (0 + margin, self._y_position, width - margin, self._y_position), width=2, fill="black"
-                        )
-
-                        # Half of an empty line space
-                        self.adjust_y_position(line_spacing / 2)
-
-        # Two empty lines
-        self.adjust_y_position(line_spacing * 2)
-
-        if options["has_notes"]:
-            draw.text((margin, self._y_position), "Notes:", fill=text_color, font=self.font)
-            self.adjust_y_position(line_spacing)
-            self.adjust_y_position(line_spacing / 2)
-            self.draw_text(draw, text=options["notes"], font=self.font, x_offset=margin, max_width=max_width)
-
-
-        print(image.width)
-
-        # See image in this for help: https://stackoverflow.com/a/71532590
-        bounding_box = image.getbbox()
-        cropped_image = None
-
-        try:
-            cropped_image = image.crop([0, 0, width, bounding_box[3] + margin])
-        except TypeError as err:
-            # Reset y coords
-            self._y_position = margin
-
-            traceback.print_exc()
+            if rows > len(window):
+                window = np.concatenate([window, background.repeat(rows - len(window), axis=0)])
+
+        for block in self.blocks(options):
+            with self._lock:
+                tile = self.tile(block, mode)
+
+            if tile.bottom:
+                bottom = max(bottom, y + tile.bottom)
+                row = round(y) - top
+                end = row + len(tile.pixels)
+
+                grow(end)
+                rows = window[row:end]
+                np.minimum(rows, tile.pixels, out=rows)
+
+            y += tile.height
+
+            # Nothing after this can draw above y anymore. Blank lists
+            # don't get any bands, they're an error at the end
+            while bottom and finished(round(y)) - top >= band_height:
+                grow(band_height)
+                yield pack(Image.fromarray(window[:band_height]))
+                window = window[band_height:]
+                top += band_height
+
+        if not bottom:
             print("ERROR: Image is empty")
-            
             raise TypeError
 
-        list_image = Image.new("RGBA", cropped_image.size, bg_color)
-        list_image.paste(cropped_image, (0, 0), cropped_image)
+        height = finished(math.inf)
+        grow(height - top)
+
+        for start in range(0, height - top, band_height):
+            yield pack(Image.fromarray(window[start:min(start + band_height, height - top)]))
+
+    def is_empty(self, options) -> bool:
+        """
+        True if the list has nothing to draw, without laying anything out.
+        The notes section always has its "Notes:" heading.
+        """
+        return not (options["title"].strip() or options["entries"] or options["has_notes"])
 
-        print(list_image.width)
+    def atlas(self, font, mode) -> GlyphAtlas:
+        atlas = self._atlases.get((font, mode))
 
-        image_bytes = io.BytesIO()
-        list_image.save(image_bytes, format="PNG")
-        self.bytes = image_bytes
+        if atlas is None:
+            atlas = GlyphAtlas(font, mode, self.glyph_cache)
+            self._atlases[(font, mode)] = atlas
+
+        return atlas
+
+    def wrapper(self, font) -> Wrapper:
+        wrapper = self._wrappers.get(font)
+
+        if wrapper is None:
+            wrapper = Wrapper(self.atlas(font, "L"))
+            self._wrappers[font] = wrapper
+
+        return wrapper
+
+    def raster(self) -> Raster:
+        """
+        The last generated image packed into printer-ready 1-bit rows.
+        Render with mode="1" first to skip the conversion.
+        """
+        if self.image is None:
+            raise ValueError("generate() has to be called before raster()")
 
-        # Reset y coords
-        self._y_position = margin
+        return pack(self.image)
@@ -0,0 +1,240 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import atexit
+import json
+import os
+import re
+import threading
+import time
+
+from files import replace
+
+# Every metric in the Prometheus textfile starts with this
+PREFIX = "listmaker"
+
+
+class Metrics:
+    def __init__(self, log_path=None, textfile=None, interval=5.0):
+        """
+        Records how long things take (spans) and how often things happen
+        (counters), so we can see where the time between pressing a button
+        and paper coming out goes.
+
+            with metrics.span("capture"):
+                picam2.capture_file(path)
+
+            metrics.count("bytes_sent", len(payload))
+            metrics.count("errors", resultcode=90)
+
+        Spans started inside another span on the same thread remember it as
+        their parent, e.g. generate > tiles.
+
+        Every span and count is appended to log_path as a line of JSON.
+        Totals are written to textfile in the Prometheus text format, for
+        node_exporter's textfile collector. Either one can be left out,
+        the totals are always kept in memory.
+
+        :param log_path: JSON lines file to append to
+        :param textfile: Prometheus .prom file to keep up to date
+        :param interval: Most seconds between textfile updates
+        """
+        self.log_path = log_path
+        self.textfile = textfile
+        self.interval = interval
+
+        # span name -> [count, total seconds, longest]
+        self.spans = defaultdict(lambda: [0, 0.0, 0.0])
+        # (name, sorted labels) -> value
+        self.counters = defaultdict(float)
+
+        self._lock = threading.Lock()
+        self._textfile_lock = threading.Lock()
+        self._local = threading.local()
+        self._log = None
+        self._written = 0
+
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+            # Line buffered, so the log is readable while the program runs
+            self._log = open(log_path, "a", buffering=1)
+
+        atexit.register(self.close)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the code inside the with block. Extra keyword arguments end up
+        in the log line, e.g. span("send", job=3). A span that raises is still
+        recorded, with the name of the exception.
+        """
+        stack = getattr(self._local, "stack", None)
+
+        if stack is None:
+            stack = self._local.stack = []
+
+        parent = stack[-1] if stack else None
+        stack.append(name)
+
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+
+        try:
+            yield
+        except BaseException as err:
+            error = type(err).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+
+            with self._lock:
+                totals = self.spans[name]
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+
+            self._write({
+                "time": started,
+                "span": name,
+                "seconds": round(seconds, 6),
+                "parent": parent,
+                "thread": threading.current_thread().name,
+                "error": error,
+                **attributes,
+            })
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds value to a counter. Labels split it up, e.g. count("jobs", state="done")
+        and count("jobs", state="failed") are counted separately.
+        """
+        key = (name, tuple(sorted((label, str(text)) for label, text in labels.items())))
+
+        with self._lock:
+            self.counters[key] += value
+
+        self._write({"time": time.time(), "count": name, "value": value, **labels})
+
+    def close(self):
+        self.write_textfile()
+
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def write_textfile(self):
+        """
+        Writes all totals to the textfile. It's written next to it first and then
+        moved over it, so the collector never reads half a file.
+        """
+        if not self.textfile:
+            return
+
+        lines = []
+
+        with self._lock:
+            spans = {name: list(totals) for name, totals in self.spans.items()}
+            counters = dict(self.counters)
+
+        if spans:
+            metric = f"{PREFIX}_span_seconds"
+            lines.append(f"# HELP {metric} Time spent in each step.")
+            lines.append(f"# TYPE {metric} summary")
+
+            for name, (count, total, _) in sorted(spans.items()):
+                lines.append(f'{metric}_count{{span="{_escape(name)}"}} {count}')
+                lines.append(f'{metric}_sum{{span="{_escape(name)}"}} {total:.6f}')
+
+            lines.append(f"# HELP {metric}_max Longest time spent in each step.")
+            lines.append(f"# TYPE {metric}_max gauge")
+
+            for name, (_, _, longest) in sorted(spans.items()):
+                lines.append(f'{metric}_max{{span="{_escape(name)}"}} {longest:.6f}')
+
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{PREFIX}_{_metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{metric}{_labels(labels)} {value:g}")
+
+        with self._textfile_lock, replace(self.textfile, "w") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def _write(self, entry):
+        with self._lock:
+            if self._log:
+                self._log.write(json.dumps(entry) + "\n")
+
+            # Writing the textfile on every span would cost more than most spans
+            due = self.textfile and time.monotonic() - self._written >= self.interval
+
+            if due:
+                self._written = time.monotonic()
+
+        if due:
+            self.write_textfile()
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{_metric_name(label)}="{_escape(text)}"' for label, text in labels) + "}"
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default() -> Metrics:
+    """
+    The Metrics everything records to, set up from METRICS_LOG and
+    METRICS_TEXTFILE the first time something gets recorded.
+    That's after main.py has loaded the .env file.
+    """
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            _default = Metrics(
+                log_path=os.environ.get("METRICS_LOG") or None,
+                textfile=os.environ.get("METRICS_TEXTFILE") or None,
+            )
+
+    return _default
+
+
+def span(name, **attributes):
+    return default().span(name, **attributes)
+
+
+def count(name, value=1, **labels):
+    default().count(name, value, **labels)
+
+
+def timed(name):
+    """
+    Decorator that puts a whole function in a span
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
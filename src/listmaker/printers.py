@@ -0,0 +1,131 @@
+from escpos.printer import Usb
+from functools import partial
+import os
+import usb.core
+
+from emulator import Emulator
+
+# What usb_printers() calls the printer while none is plugged in. It opens
+# whichever one turns up first, so it's dropped once they have their own names.
+ANY_PRINTER = "usb"
+
+
+def usb_printer(port=None):
+    """
+    Opens the TM-T88V described in the .env file
+
+    :param port: (bus, port numbers) of the printer to open, from usb_printers().
+                 None opens the first one found.
+    """
+    usb_args = {}
+
+    if port is not None:
+        usb_args["custom_match"] = lambda device: (device.bus, device.port_numbers) == port
+
+    printer = Usb(
+        idVendor=int(os.environ["VENDOR_ID"], 16),
+        idProduct=int(os.environ["PRODUCT_ID"], 16),
+        usb_args=usb_args,
+        in_ep=int(os.environ["IN_EP"], 16),
+        out_ep=int(os.environ["OUT_EP"], 16),
+        profile="TM-T88V",
+    )
+    printer.open()
+
+    return printer
+
+
+def usb_printers():
+    """
+    Every printer plugged in that matches VENDOR_ID and PRODUCT_ID, as
+    {name: function that opens it}. Printers are named after the USB port
+    they're plugged in to, e.g. usb-1-1.3, so a printer that gets unplugged
+    and plugged back into the same port is still the same printer.
+    """
+    try:
+        devices = usb.core.find(
+            find_all=True,
+            idVendor=int(os.environ["VENDOR_ID"], 16),
+            idProduct=int(os.environ["PRODUCT_ID"], 16),
+        )
+        printers = {}
+
+        for device in devices:
+            ports = device.port_numbers or ()
+            name = f"usb-{device.bus}-" + ".".join(map(str, ports))
+            printers[name] = partial(usb_printer, (device.bus, device.port_numbers))
+    except (KeyError, ValueError, usb.core.NoBackendError):
+        # No printer settings (e.g. the List Maker without a .env file) or no libusb,
+        # that's only a problem once something gets printed
+        printers = {}
+
+    # Nothing plugged in yet, keep trying whichever printer turns up first
+    return printers or {ANY_PRINTER: usb_printer}
+
+
+def emulated_printer(name=None):
+    """
+    A pretend printer (see emulator.py) that saves receipts to RECEIPT_DIR.
+    EMULATOR_REALTIME=0 makes it print as fast as it can instead of
+    as fast as the real one would.
+
+    :param name: Saves the receipts in a directory with this name inside RECEIPT_DIR
+    """
+    directory = os.environ.get("RECEIPT_DIR") or None
+
+    if directory and name:
+        directory = os.path.join(directory, name)
+
+    return Emulator(
+        directory=directory,
+        realtime=os.environ.get("EMULATOR_REALTIME", "1") != "0",
+    )
+
+
+def emulated_printers():
+    """
+    EMULATED_PRINTERS pretend printers (1 if it isn't set), to try out printing
+    with several printers. Each one saves its receipts in its own directory.
+    """
+    number = int(os.environ.get("EMULATED_PRINTERS") or 1)
+
+    if number == 1:
+        return {"emulator": emulated_printer}
+
+    return {f"emulator-{i}": partial(emulated_printer, f"printer-{i}") for i in range(1, number + 1)}
+
+
+# Everything PRINTER can be set to, with the functions that
+# open one printer and find all of them
+BACKENDS = {
+    "usb": (usb_printer, usb_printers),
+    "emulator": (emulated_printer, emulated_printers),
+}
+
+
+def backend(name=None):
+    """
+    The function that opens the printer picked with the PRINTER
+    environment variable, USB if it isn't set
+
+    :param name: Use this backend instead of the one in PRINTER
+    """
+    return _backend(name)[0]
+
+
+def discover(name=None):
+    """
+    Every printer of the backend picked with PRINTER, as {name: function that opens it}
+
+    :param name: Use this backend instead of the one in PRINTER
+    """
+    return _backend(name)[1]()
+
+
+def _backend(name):
+    name = name or os.environ.get("PRINTER") or "usb"
+
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown printer backend {name!r}, pick one of: {', '.join(BACKENDS)}") from None
@@ -0,0 +1,266 @@
+from PIL import Image
+from dataclasses import dataclass
+import numpy as np
+import re
+
+# ESC/POS command prefixes
+ESC = b"\x1b"
+GS = b"\x1d"
+
+# Max-width of the TM-T88V in dots
+PRINTER_WIDTH = 512
+
+# Same as python-escpos, taller images are sent in pieces
+# so they fit in the printer's receive buffer
+FRAGMENT_HEIGHT = 960
+
+# White gaps shorter than this are sent as rows anyway. Every gap that's
+# fed past splits the image in two, and the printer can pause between images.
+MIN_GAP = 24
+
+
+@dataclass
+class Raster:
+    """
+    A 1-bit image packed the way the printer wants it.
+
+    Each row is width_bytes long, 8 dots per byte with the left-most dot
+    in the most significant bit. A 1 bit is a black dot (burned) and a 0 bit
+    is left white, which is the opposite of Pillow's "1" mode.
+    """
+    width: int
+    height: int
+    data: bytes
+
+    @property
+    def width_bytes(self):
+        return (self.width + 7) // 8
+
+
+def pack(image: Image.Image, threshold=128) -> Raster:
+    """
+    Converts any Pillow image into a Raster.
+
+    "1" mode images are used as is. Everything else becomes grayscale
+    and any pixel darker than the threshold turns into a black dot.
+    Photos should be dithered to "1" mode first, a plain threshold
+    throws away all the midtones.
+
+    :param image: The image to pack
+    :param threshold: Gray level (0-255) below which a pixel is printed
+    """
+    if image.mode == "1":
+        # Pillow's "1" mode is True for white
+        dots = ~np.asarray(image)
+    else:
+        if "A" in image.getbands():
+            # Transparent pixels should come out white, not black
+            background = Image.new("RGBA", image.size, "white")
+            background.alpha_composite(image.convert("RGBA"))
+            image = background
+
+        dots = np.asarray(image.convert("L")) < threshold
+
+    # packbits() pads every row up to a whole byte with zeros (white)
+    data = np.packbits(dots, axis=1)
+
+    return Raster(width=image.width, height=image.height, data=data.tobytes())
+
+
+def _low_high(number, length=2):
+    """
+    ESC/POS sends numbers as little-endian bytes, e.g. 512 -> 00 02
+    """
+    return number.to_bytes(length, "little")
+
+
+def _graphics_data(fn, data):
+    """
+    GS ( L  pL pH  m fn [data]
+
+    pL pH is the length of everything after it, m is always 48 ("0").
+    """
+    return GS + b"(L" + _low_high(len(data) + 2) + b"0" + fn + data
+
+
+class Payload(bytes):
+    """
+    Encoded ESC/POS commands. Works everywhere bytes do, saved is how many
+    bytes of blank rows and columns encode() left out of it.
+    """
+    saved = 0
+
+
+def encode(
+    raster: Raster,
+    impl="bitImageRaster",
+    fragment_height=FRAGMENT_HEIGHT,
+    skip_blank=True,
+    min_gap=MIN_GAP,
+) -> Payload:
+    """
+    Turns a Raster into the ESC/POS commands that print it.
+
+    The implementations are named the same as python-escpos:
+        * `bitImageRaster`: GS v 0
+        * `graphics`: GS ( L (store the graphics, then print them)
+
+    Lists are mostly white paper, so with skip_blank every stretch of at
+    least min_gap white rows is fed past with ESC J instead of being sent
+    as rows of zeros, and white columns on the right of each piece are cut
+    off. Narrower pieces only line up because images print left aligned
+    (ESC a 0), which is what the printer starts with.
+
+    The result is a plain bytes payload, so it can be kept around
+    and sent as many times as needed with send().
+
+    :param raster: The packed image
+    :param impl: Which ESC/POS image command to use
+    :param fragment_height: Images taller than this are split into pieces
+    :param skip_blank: Feed past white rows and leave out white columns
+    :param min_gap: Fewest white rows in a row worth a feed, shorter gaps
+                    cost more in command headers than they save
+    """
+    if raster.width > PRINTER_WIDTH:
+        raise ValueError(f"Image is {raster.width} dots wide, the printer only fits {PRINTER_WIDTH}")
+
+    if impl not in ("bitImageRaster", "graphics"):
+        raise ValueError(f"Unknown image implementation: {impl}")
+
+    row_bytes = raster.width_bytes
+    rows = np.frombuffer(raster.data, dtype=np.uint8).reshape(raster.height, row_bytes)
+    payload = []
+
+    pieces = _pieces(rows, min_gap) if skip_blank else [(0, raster.height, False)]
+
+    for start, stop, blank in pieces:
+        if blank:
+            payload.append(_feed(stop - start))
+            continue
+
+        for top in range(start, stop, fragment_height):
+            fragment = rows[top:min(top + fragment_height, stop)]
+
+            if skip_blank:
+                columns = np.flatnonzero(fragment.any(axis=0))
+
+                # A fragment can end up all white where a short gap gets split
+                if not columns.size:
+                    payload.append(_feed(len(fragment)))
+                    continue
+
+                # Bytes up to the right-most one with any black dots in it
+                width_bytes = int(columns[-1]) + 1
+                fragment = fragment[:, :width_bytes]
+                width = min(raster.width, width_bytes * 8)
+            else:
+                width_bytes, width = row_bytes, raster.width
+
+            payload.append(_image(fragment.tobytes(), impl, width_bytes, width, len(fragment)))
+
+    # What it would have taken without skipping, for Payload.saved
+    fragments = -(-raster.height // fragment_height)
+    plain = row_bytes * raster.height + fragments * len(_image(b"", impl, 0, 0, 0))
+
+    result = Payload(b"".join(payload))
+    result.saved = plain - len(result) if skip_blank else 0
+
+    return result
+
+
+def _pieces(rows, min_gap):
+    """
+    Splits the rows into (start, stop, blank) pieces. Blank pieces are at least
+    min_gap rows of white, shorter white gaps stay part of the rows around them.
+    """
+    ink = rows.any(axis=1)
+
+    if not ink.any():
+        return [(0, len(rows), True)] if len(rows) else []
+
+    # Rows where ink starts or stops
+    edges = [0, *(np.flatnonzero(np.diff(ink.astype(np.int8))) + 1), len(rows)]
+    pieces = []
+
+    for start, stop in zip(edges, edges[1:]):
+        blank = not ink[start]
+
+        if blank and stop - start >= min_gap:
+            pieces.append((start, stop, True))
+        elif pieces and not pieces[-1][2]:
+            pieces[-1] = (pieces[-1][0], stop, False)
+        else:
+            pieces.append((start, stop, False))
+
+    # Short gaps at the very top or bottom don't need an extra image command
+    first = pieces[0]
+
+    if not ink[first[0]] and not first[2]:
+        top = int(np.argmax(ink))
+        pieces[0:1] = [(first[0], top, True), (top, first[1], False)]
+
+    last = pieces[-1]
+
+    if not ink[last[1] - 1] and not last[2]:
+        bottom = len(rows) - int(np.argmax(ink[::-1]))
+        pieces[-1:] = [(last[0], bottom, False), (bottom, last[1], True)]
+
+    return pieces
+
+
+def _image(data, impl, width_bytes, width, height):
+    if impl == "bitImageRaster":
+        # GS v 0 m xL xH yL yH, m = 0 is normal density
+        # x is in bytes, y is in dots
+        return GS + b"v0\x00" + _low_high(width_bytes) + _low_high(height) + data
+
+    # a = "0" monochrome, bx = by = 1 normal size, c = "1" first color
+    # then the width and height in dots
+    header = b"0\x01\x011" + _low_high(width) + _low_high(height)
+    return _graphics_data(b"p", header + data) + _graphics_data(b"2", b"")
+
+
+def _feed(dots):
+    """
+    ESC J n feeds the paper n dots without printing anything, at most 255 at a time
+    """
+    full, rest = divmod(dots, 255)
+    return (ESC + b"J\xff") * full + (ESC + b"J" + bytes([rest]) if rest else b"")
+
+
+def send(printer, payload: bytes) -> None:
+    """
+    Sends an already encoded payload straight to a python-escpos printer.
+    No image conversion happens here, it's just bytes down the wire.
+    """
+    printer._raw(payload)
+
+
+def to_pbm(raster: Raster) -> bytes:
+    """
+    Saves a Raster as a binary PBM (P4) image. PBM packs its rows the exact
+    same way as the printer, 1 is black and rows are padded to whole bytes,
+    so the data goes in unchanged and any image viewer can open the file.
+    """
+    return b"P4\n%d %d\n" % (raster.width, raster.height) + raster.data
+
+
+def from_pbm(data: bytes) -> Raster:
+    """
+    Reads a Raster back from to_pbm(). Only the plain header written
+    there is understood, not comments or the ASCII (P1) variant.
+    """
+    # Exactly one whitespace byte after the height,
+    # the pixels themselves can start with whitespace bytes
+    header = re.match(rb"P4\s+(\d+)\s+(\d+)\s", data)
+
+    if not header:
+        raise ValueError("Not a binary PBM image")
+
+    pixels = data[header.end():]
+    raster = Raster(width=int(header[1]), height=int(header[2]), data=pixels)
+
+    if len(pixels) != raster.width_bytes * raster.height:
+        raise ValueError(f"PBM should have {raster.width_bytes * raster.height} bytes of pixels, has {len(pixels)}")
+
+    return raster
@@ -0,0 +1,271 @@
+from PIL import Image
+from collections import OrderedDict
+import hashlib
+import io
+import json
+import os
+import struct
+import threading
+
+from files import font_stamp, replace
+from metrics import count
+from raster import Payload, encode
+
+# Part of every key, bump it when lists start to render differently
+# so renders saved on disk by older versions aren't used anymore
+VERSION = 2
+
+# Saved payloads start with how many bytes blank skipping saved (Payload.saved)
+SAVED = struct.Struct("<Q")
+
+# Payloads bigger than this aren't cached, that's a list of about 300 entries
+MAX_PAYLOAD = 1_000_000
+
+
+class RenderCache:
+    def __init__(self, list_image, text_list=None, size=16, directory=None, disk_size=256, max_payload=MAX_PAYLOAD):
+        """
+        Whole lists that were already rendered, as images and as printer payloads.
+
+        Clicking Preview, Save Image and Submit for the same list would
+        otherwise draw it three times, and printing it again would draw
+        and encode it all over. Now only the first one does the work.
+
+        Renders are found by a hash of the list's options together with
+        everything else that changes how it looks: the ImageSettings and
+        the font files. Change anything and it's a different key, so a
+        stale render is never handed out.
+
+        The size most recently used renders are kept in memory. With a
+        directory they're also saved there (images as PNG, payloads as is),
+        so they survive restarts. Only the disk_size most recently used
+        files are kept. Renders that are asked for with disk=False, like
+        the live preview on every pause in typing, stay in memory only.
+
+        Payloads over max_payload bytes aren't cached, so printing a very
+        long list band by band never holds the whole payload in memory.
+
+        :param list_image: ListImage that renders the lists
+        :param text_list: TextList for text mode payloads, see textlist.py
+        :param size: How many renders to keep in memory
+        :param directory: Where to save renders, None to only keep them in memory
+        :param disk_size: How many renders to keep on disk
+        :param max_payload: Biggest payload to cache in bytes
+        """
+        self.list_image = list_image
+        self.text_list = text_list
+        self.size = size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.max_payload = max_payload
+
+        self._renders = OrderedDict()
+        self._lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, options, kind) -> str:
+        """
+        Hash of everything that goes into a render
+
+        :param kind: What's rendered, e.g. "image-L" or "payload-text"
+        """
+        fonts = [self.list_image.font, self.list_image.bold_font]
+
+        if kind == "payload-text":
+            fonts.append(self.text_list.font)
+
+        document = {
+            "version": VERSION,
+            "kind": kind,
+            "options": options,
+            "settings": list(self.list_image.settings),
+            "fonts": [font_stamp(font) for font in fonts],
+        }
+
+        return hashlib.sha256(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+
+    def image(self, options, mode=None, disk=True) -> Image.Image:
+        """
+        Same as ListImage.generate(), including the TypeError for empty lists.
+        Don't change the image that comes back, it's the one in the cache.
+
+        :param disk: False to neither look on disk nor save there
+        """
+        mode = mode or self.list_image.settings.mode
+        key = self.key(options, f"image-{mode}")
+        image = self._get(key, disk)
+
+        if image is None:
+            image = self.list_image.generate(options, mode)
+            self._put(key, image, disk)
+
+        return image
+
+    def payload(self, options, impl="bitImageRaster") -> bytes:
+        """
+        The ESC/POS payload that prints the list
+
+        :param impl: Image command for raster.encode(), or "text" for TextList
+        """
+        key = self.key(options, f"payload-{impl}")
+        payload = self._get(key)
+
+        if payload is None:
+            if impl == "text":
+                payload = self.text_list.encode(options)
+            else:
+                payload = _join([encode(band, impl) for band in self.list_image.bands(options)])
+
+            if len(payload) <= self.max_payload:
+                self._put(key, payload)
+
+        return payload
+
+    def stream(self, options, impl="bitImageRaster"):
+        """
+        For Spooler.submit(): the cached payload if there is one, otherwise
+        the list's bands, encoded as they're drawn (see ListImage.bands()).
+        The payload is cached once the last band is done, unless it got
+        bigger than max_payload on the way.
+        """
+        if impl == "text":
+            # Text is quick to make, there's nothing to stream
+            return self.payload(options, impl)
+
+        key = self.key(options, f"payload-{impl}")
+        payload = self._get(key)
+
+        if payload is not None:
+            return payload
+
+        return self._stream(key, options, impl)
+
+    def _stream(self, key, options, impl):
+        chunks = []
+        size = 0
+
+        for band in self.list_image.bands(options):
+            chunk = encode(band, impl)
+            size += len(chunk)
+
+            if size > self.max_payload:
+                # Too big to cache, the bands that were kept can go
+                chunks = None
+            elif chunks is not None:
+                chunks.append(chunk)
+
+            yield chunk
+
+        if chunks is not None:
+            self._put(key, _join(chunks))
+
+    def _get(self, key, disk=True):
+        with self._lock:
+            render = self._renders.get(key)
+
+            if render is not None:
+                self._renders.move_to_end(key)
+
+        if render is not None:
+            count("render_cache", result="hit")
+
+            # A live preview render that's now asked for for real
+            if disk and self.directory and not self._saved(key):
+                self._save(key, render)
+
+            return render
+
+        render = self._load(key) if disk else None
+
+        if render is None:
+            count("render_cache", result="miss")
+            return None
+
+        count("render_cache", result="disk")
+
+        with self._lock:
+            self._keep(key, render)
+
+        return render
+
+    def _put(self, key, render, disk=True):
+        with self._lock:
+            self._keep(key, render)
+
+        if disk and self.directory:
+            self._save(key, render)
+
+    def _keep(self, key, render):
+        self._renders[key] = render
+        self._renders.move_to_end(key)
+
+        while len(self._renders) > self.size:
+            self._renders.popitem(last=False)
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+
+        for extension in (".png", ".bin"):
+            path = os.path.join(self.directory, key + extension)
+
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+            except FileNotFoundError:
+                continue
+
+            # Keeps the file from being thrown out as one of the oldest
+            os.utime(path)
+
+            if extension == ".bin":
+                payload = Payload(data[SAVED.size:])
+                payload.saved, = SAVED.unpack_from(data)
+                return payload
+
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            return image
+
+        return None
+
+    def _saved(self, key):
+        return any(
+            os.path.exists(os.path.join(self.directory, key + extension))
+            for extension in (".png", ".bin")
+        )
+
+    def _save(self, key, render):
+        if isinstance(render, Image.Image):
+            path = os.path.join(self.directory, key + ".png")
+            buffer = io.BytesIO()
+            render.save(buffer, "PNG")
+            data = buffer.getvalue()
+        else:
+            path = os.path.join(self.directory, key + ".bin")
+            data = SAVED.pack(getattr(render, "saved", 0)) + render
+
+        # Nothing ever loads half a render
+        with replace(path) as file:
+            file.write(data)
+
+        with os.scandir(self.directory) as entries:
+            files = [entry for entry in entries if entry.name.endswith((".png", ".bin"))]
+
+        if len(files) > self.disk_size:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+
+            for entry in files[:len(files) - self.disk_size]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def _join(chunks):
+    payload = Payload(b"".join(chunks))
+    payload.saved = sum(getattr(chunk, "saved", 0) for chunk in chunks)
+
+    return payload
@@ -0,0 +1,529 @@
+from escpos.exceptions import Error, DeviceNotFoundError
+from dataclasses import dataclass, field
+import itertools
+import queue
+import threading
+import time
+import traceback
+from typing import Iterable
+import usb.core
+
+from metrics import count, span
+from printers import ANY_PRINTER, backend, discover
+from raster import send
+
+# Most seconds between looks for printers that were plugged in, see PrinterPool
+REDISCOVER = 10
+
+
+class Prefetch:
+    def __init__(self, chunks: Iterable[bytes], ahead=2):
+        """
+        Runs through chunks on its own thread, staying up to ahead chunks in
+        front of whoever is using them. Errors come out on the using side.
+
+        The thread starts right away, so the first chunks get made while the
+        printer connects. It stops once the last chunk was taken, or when
+        close() is called, e.g. because the job failed before it got that far.
+        """
+        self._ready = queue.Queue(maxsize=ahead)
+        self._stop = threading.Event()
+        self._chunks = chunks
+
+        threading.Thread(target=self._produce, name="prefetch", daemon=True).start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self._stop.is_set():
+            raise StopIteration
+
+        chunk, error = self._ready.get()
+
+        if error is not None:
+            self.close()
+            raise error
+
+        if chunk is None:
+            self.close()
+            raise StopIteration
+
+        return chunk
+
+    def close(self):
+        """
+        Lets the thread go, whatever it hasn't made yet is never made
+        """
+        self._stop.set()
+
+    def _put(self, item):
+        # Gives up if nobody is taking chunks anymore
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _produce(self):
+        try:
+            for chunk in self._chunks:
+                if not self._put((chunk, None)):
+                    return
+
+            self._put((None, None))
+        except Exception as err:
+            self._put((None, err))
+
+
+@dataclass
+class Job:
+    """
+    One thing to print, an already encoded payload (see raster.encode)
+    or an iterable of payload chunks that are sent as they're made.
+
+    state goes queued -> printing -> done or failed.
+    If it failed, error has the escpos exception.
+
+    started is set once part of a streamed payload was sent, after that the
+    job can't be retried or moved to another printer. rerouted counts how
+    often a PrinterPool moved it to another printer.
+
+    bytes_sent is how much went to the printer, bytes_saved how much
+    raster.encode() left out by feeding past blank paper.
+    """
+    id: int
+    payload: bytes | Iterable[bytes]
+    cut: bool = True
+    state: str = "queued"
+    error: Error = None
+    started: bool = False
+    bytes_sent: int = 0
+    bytes_saved: int = 0
+    rerouted: int = 0
+    _chunks: Iterable[bytes] = field(default=None, repr=False)
+    _finished: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Blocks until the job is done or failed.
+        Returns False if the timeout ran out first.
+        """
+        return self._finished.wait(timeout)
+
+
+@dataclass
+class SpoolerStatus:
+    connected: bool
+    queued: int
+    current_job: int
+    last_error: Error
+
+
+@dataclass
+class Device:
+    """
+    One printer in a PrinterPool. It's out of rotation until down_until
+    (time.monotonic()), delay is how long it's taken out the next time it fails.
+    """
+    name: str
+    spooler: "Spooler"
+    delay: float
+    down_until: float = 0.0
+
+
+class Spooler:
+    def __init__(self, connect=None, attempts=5, backoff=0.5, max_backoff=30, name="spooler", reroute=None):
+        """
+        Keeps one printer connection open and prints jobs one after another
+        on a background thread.
+
+        If the printer disappears (unplugged, turned off) the connection is
+        thrown away and the job is retried on a fresh one, waiting twice
+        as long after every failed attempt.
+
+        :param connect: Function that returns an open python-escpos printer,
+                        defaults to the backend picked with PRINTER (see printers.py)
+        :param attempts: How many times a job is tried before it fails
+        :param backoff: Seconds to wait after the first failed attempt
+        :param max_backoff: Longest wait between attempts in seconds
+        :param name: Name of the background thread
+        :param reroute: Called with (spooler, job) when a job fails because the
+                        printer isn't there. If it returns True, the job was handed
+                        to another spooler and doesn't count as failed. See PrinterPool.
+        """
+        self.connect = connect or backend()
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reroute = reroute
+
+        self.printer = None
+        self.last_error = None
+        # time.monotonic() before which the printer isn't tried again
+        self.resume_at = 0.0
+        self._current = None
+        self._ids = itertools.count(1)
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, payload, cut=True) -> Job:
+        """
+        Adds a payload to the end of the queue and returns right away.
+        Use job.wait() to block until it's printed.
+
+        The payload can also be an iterable of chunks, e.g. encoded bands
+        from ListImage.bands(). The chunks are made on their own thread while
+        the ones before them are sent, so the printer starts on the first
+        chunk without waiting for the rest.
+        """
+        job = Job(id=next(self._ids), payload=payload, cut=cut)
+        self.put(job)
+
+        return job
+
+    def put(self, job: Job):
+        """
+        Adds a job that was made somewhere else to the end of the queue
+        """
+        self._jobs.put(job)
+
+    def drain(self) -> list[Job]:
+        """
+        Takes every job that hasn't started printing out of the queue
+        """
+        jobs = []
+
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+
+            if job is None:
+                # close() was called, that has to stay in the queue
+                self._jobs.put(None)
+                break
+
+            jobs.append(job)
+
+        return jobs
+
+    @property
+    def load(self) -> int:
+        """
+        Jobs waiting plus the one printing right now
+        """
+        return self._jobs.qsize() + (self._current is not None)
+
+    def status(self) -> SpoolerStatus:
+        current = self._current
+
+        return SpoolerStatus(
+            connected=self.printer is not None,
+            queued=self._jobs.qsize(),
+            current_job=current.id if current else None,
+            last_error=self.last_error,
+        )
+
+    def close(self):
+        """
+        Prints whatever is still queued, then closes the connection
+        """
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+
+            if job is None:
+                break
+
+            self._current = job
+            job.state = "printing"
+
+            try:
+                self._print(job)
+                job.state = "done"
+                count("jobs", state="done")
+            except Exception as err:
+                rerouted = (
+                    self.reroute is not None
+                    and isinstance(err, DeviceNotFoundError)
+                    and not job.started
+                    and self.reroute(self, job)
+                )
+
+                if rerouted:
+                    self._current = None
+                    continue
+
+                traceback.print_exc()
+
+                # Chunks can fail while they're being made too,
+                # those errors get wrapped so every failed job has a resultcode
+                if not isinstance(err, Error):
+                    err = Error(f"{type(err).__name__}: {err}")
+
+                print(f"ERROR {err.resultcode}: {err.msg}")
+
+                job.error = err
+                job.state = "failed"
+                self.last_error = err
+
+                count("jobs", state="failed")
+                count("errors", resultcode=err.resultcode)
+
+                # Nothing is going to take the rest of the chunks
+                if job._chunks is not None:
+                    job._chunks.close()
+
+            self._current = None
+            job._finished.set()
+
+        self._disconnect()
+
+    def _print(self, job):
+        delay = self.backoff
+        streaming = not isinstance(job.payload, (bytes, bytearray))
+
+        # Kept with the job, so a job that moves to another printer
+        # doesn't lose the chunks that were already made
+        if streaming and job._chunks is None:
+            job._chunks = Prefetch(job.payload)
+
+        # Set by PrinterPool while this printer is out of rotation
+        wait = self.resume_at - time.monotonic()
+
+        if wait > 0 and self.printer is None:
+            time.sleep(wait)
+
+        for attempt in range(1, self.attempts + 1):
+            try:
+                if self.printer is None:
+                    with span("connect"):
+                        self.printer = self.connect()
+
+                with span("send", job=job.id):
+                    if streaming:
+                        for chunk in job._chunks:
+                            job.started = True
+                            send(self.printer, chunk)
+                            self._sent(job, chunk)
+                    else:
+                        send(self.printer, job.payload)
+                        self._sent(job, job.payload)
+
+                if job.cut:
+                    with span("cut", job=job.id):
+                        self.printer.cut()
+
+                return
+            except (DeviceNotFoundError, usb.core.USBError) as err:
+                # The printer went away, so the connection is no good anymore
+                self._disconnect()
+
+                # Chunks that were already sent can't be sent again,
+                # so a stream can only be retried before it starts
+                if attempt == self.attempts or job.started:
+                    if isinstance(err, usb.core.USBError):
+                        raise DeviceNotFoundError(str(err)) from err
+                    raise
+
+                print(f"Printer not available, retrying in {delay}s...")
+                count("retries")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def _sent(self, job, payload):
+        saved = getattr(payload, "saved", 0)
+        job.bytes_sent += len(payload)
+        job.bytes_saved += saved
+
+        count("bytes_sent", len(payload))
+
+        if saved:
+            count("bytes_saved", saved)
+
+    def _disconnect(self):
+        if self.printer is None:
+            return
+
+        try:
+            self.printer.close()
+        except Exception:
+            # Closing a printer that was unplugged can fail too, nothing to do
+            pass
+
+        self.printer = None
+
+
+class PrinterPool:
+    def __init__(self, printers=None, attempts=5, backoff=0.5, max_backoff=30):
+        """
+        Prints on every printer that's plugged in. Each printer gets its own
+        Spooler, so its own queue and connection, and every job goes to the
+        printer with the fewest jobs waiting. With three printers, three
+        receipts print at the same time.
+
+        A printer that can't be reached is taken out of rotation and the job,
+        along with everything else waiting for that printer, moves to the
+        others. After a while it's given another go, waiting twice as long
+        every time it's still not there. If no printer is left, jobs wait
+        for whichever one is due to come back first.
+
+        Works the same as a Spooler for everything that prints, so
+        one printer on its own is just a pool of one.
+
+        Printers that get plugged in later join the pool. They're looked
+        for every REDISCOVER seconds when jobs come in, and right away
+        when none of the printers work.
+
+        :param printers: {name: function that opens the printer}, defaults to
+                         every printer of the backend picked with PRINTER
+                         (see printers.discover)
+        :param attempts: How many printers a job is tried on before it fails
+        :param backoff: Seconds a printer is out of rotation after it first fails
+        :param max_backoff: Longest a printer is out of rotation in seconds
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Printers are looked for again now and then, see _rediscover()
+        self._discover = printers is None
+        self._discovered = time.monotonic()
+        self._devices = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+        self.add(discover() if printers is None else printers)
+
+    def add(self, printers):
+        """
+        Adds printers that aren't in the pool yet
+
+        :param printers: {name: function that opens the printer}
+        """
+        with self._lock:
+            for name, connect in printers.items():
+                if name in self._devices:
+                    continue
+
+                spooler = Spooler(
+                    connect,
+                    attempts=1,
+                    backoff=self.backoff,
+                    name=f"spooler-{name}",
+                    reroute=self._reroute,
+                )
+                self._devices[name] = Device(name, spooler, delay=self.backoff)
+
+                if len(printers) > 1 or len(self._devices) > 1:
+                    print(f"Printing on {name}")
+
+    def submit(self, payload, cut=True) -> Job:
+        """
+        Same as Spooler.submit(), on whichever printer is least busy
+        """
+        job = Job(id=next(self._ids), payload=payload, cut=cut)
+        self._pick().spooler.put(job)
+
+        return job
+
+    def status(self) -> dict[str, SpoolerStatus]:
+        with self._lock:
+            return {name: device.spooler.status() for name, device in self._devices.items()}
+
+    def close(self):
+        """
+        Prints whatever is still queued, then closes every connection
+        """
+        with self._lock:
+            devices = list(self._devices.values())
+
+        for device in devices:
+            device.spooler.close()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _pick(self) -> Device:
+        with self._lock:
+            now = time.monotonic()
+
+            for device in self._devices.values():
+                # Connected means it came back, so the next failure starts over
+                if device.spooler.printer is not None:
+                    device.delay = self.backoff
+
+            healthy = [device for device in self._devices.values() if device.down_until <= now]
+
+            if self._discover and (not healthy or now - self._discovered >= REDISCOVER):
+                self._rediscover()
+                healthy = [device for device in self._devices.values() if device.down_until <= now]
+
+            if not healthy:
+                # The spooler waits until the printer is due back before trying it
+                healthy = [min(self._devices.values(), key=lambda device: device.down_until)]
+
+            return min(healthy, key=lambda device: device.spooler.load)
+
+    def _rediscover(self):
+        """
+        Adds printers that were plugged in since the last look
+        """
+        self._discovered = time.monotonic()
+        printers = discover()
+        self.add(printers)
+
+        # ANY_PRINTER would open one of the printers that now have their own
+        # names, and the two would fight over it, so its jobs move to them
+        stand_in = self._devices.get(ANY_PRINTER)
+
+        if stand_in is None or printers.keys() == {ANY_PRINTER}:
+            return
+
+        del self._devices[ANY_PRINTER]
+
+        for moved in stand_in.spooler.drain():
+            self._pick().spooler.put(moved)
+
+        # Lets the job it's busy with finish, without waiting for it here
+        threading.Thread(target=stand_in.spooler.close, name="close-any-printer", daemon=True).start()
+
+    def _reroute(self, spooler, job) -> bool:
+        """
+        Called on a spooler's thread when its printer can't be reached
+        """
+        with self._lock:
+            device = next((device for device in self._devices.values() if device.spooler is spooler), None)
+
+            if device is None:
+                # Left the pool (see _rediscover), the job goes to a printer that's still in it
+                job.state = "queued"
+                self._pick().spooler.put(job)
+                return True
+
+            device.down_until = time.monotonic() + device.delay
+            spooler.resume_at = device.down_until
+            print(f"Printer {device.name} not available, trying it again in {device.delay}s")
+            device.delay = min(device.delay * 2, self.max_backoff)
+
+            job.rerouted += 1
+
+            if job.rerouted >= self.attempts:
+                return False
+
+            count("reroutes", printer=device.name)
+
+            for moved in [job] + spooler.drain():
+                moved.state = "queued"
+                self._pick().spooler.put(moved)
+
+        return True
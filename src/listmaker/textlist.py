@@ -0,0 +1,219 @@
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+import os
+import textwrap
+
+from image import SYMBOLS
+from raster import ESC, PRINTER_WIDTH
+
+# Font A of the TM-T88V, in dots
+CHAR_WIDTH = 12
+CHAR_HEIGHT = 24
+COLUMNS = PRINTER_WIDTH // CHAR_WIDTH
+
+# What ESC @ leaves the printer with, PC437 (ESC t 0)
+CODE_PAGE = "cp437"
+
+# ESC ! print modes
+NORMAL = 0
+BOLD = 8
+DOUBLE_HEIGHT = 16
+DOUBLE_WIDTH = 32
+TITLE = BOLD | DOUBLE_HEIGHT | DOUBLE_WIDTH
+
+# A horizontal box drawing line, the printer's font joins them up into one rule
+RULE = "─"
+
+# Codes ESC & can put user-defined characters in
+USER_CODES = range(32, 127)
+
+
+class TextList:
+    def __init__(self, font_path=None):
+        """
+        Prints lists as text in the printer's own font instead of as an image.
+
+        Takes the same options as ListImage.generate(). The title is printed
+        bold at double size, entries and notes in font A and separators as
+        a line of box drawing characters. A list like that is a few hundred
+        bytes instead of tens of KB of raster, and prints as fast as the
+        printer prints text.
+
+        The list symbols (and anything else the code page doesn't have)
+        are drawn with the list's font and sent as user-defined characters
+        (ESC &), 36 bytes each, once per list.
+
+        Text lines break at whole characters, so a list looks a bit different
+        from the ListImage preview: same words, but in the printer's font.
+
+        :param font_path: Font the missing characters are drawn with,
+                          the regular list font by default
+        """
+        path = font_path or os.path.join(os.getcwd(), "assets", "Iosevka-Extended.ttf")
+
+        # As big as fits in a character cell
+        ascent, descent = ImageFont.truetype(path, CHAR_HEIGHT).getmetrics()
+        self.font = ImageFont.truetype(path, CHAR_HEIGHT * CHAR_HEIGHT // (ascent + descent))
+
+        self._glyphs = {}
+
+    def lines(self, options) -> list:
+        """
+        The list as (print mode, text) lines, wrapped to fit the paper
+        """
+        lines = []
+
+        # The title is double width, so only half as many characters fit
+        for line in textwrap.wrap(options["title"], COLUMNS // 2) or [""]:
+            lines.append((TITLE, line))
+
+        lines.append((NORMAL, ""))
+
+        entries = options["entries"]
+        list_type = options["list_type"]
+
+        for number, entry in enumerate(entries):
+            symbol = f"{number + 1})" if list_type == "number" else SYMBOLS.get(list_type)
+            # Wrapped lines line up with the text after the symbol
+            indent = " " * (len(f"{symbol}") + 1)
+
+            for line in textwrap.wrap(f"{symbol} {entry}", COLUMNS, subsequent_indent=indent) or [""]:
+                lines.append((NORMAL, line))
+
+            if options["has_separators"] and number != len(entries) - 1:
+                lines.append((NORMAL, RULE * COLUMNS))
+
+        # Two empty lines
+        lines.append((NORMAL, ""))
+        lines.append((NORMAL, ""))
+
+        if options["has_notes"]:
+            lines.append((NORMAL, "Notes:"))
+
+            for paragraph in options.get("notes", "").splitlines() or [""]:
+                for line in textwrap.wrap(paragraph, COLUMNS) or [""]:
+                    lines.append((NORMAL, line))
+
+        return lines
+
+    def encode(self, options) -> bytes:
+        """
+        The ESC/POS commands that print the list
+        """
+        lines = self.lines(options)
+
+        # Every character the code page doesn't have gets a user-defined code
+        missing = []
+
+        for _, text in lines:
+            for char in text:
+                if char not in missing and char >= " " and not _printable(char):
+                    missing.append(char)
+
+        codes = dict(zip(missing, USER_CODES))
+
+        # ESC @ resets everything, including the code page and line spacing
+        payload = [ESC + b"@"]
+
+        if codes:
+            payload.append(self._define(codes))
+
+        mode = NORMAL
+
+        for line_mode, text in lines:
+            if line_mode != mode:
+                payload.append(ESC + b"!" + bytes([line_mode]))
+                mode = line_mode
+
+            payload.append(_encode_line(text, codes))
+            payload.append(b"\n")
+
+        if mode != NORMAL:
+            payload.append(ESC + b"!" + bytes([NORMAL]))
+
+        return b"".join(payload)
+
+    def glyph(self, char) -> bytes:
+        """
+        A character drawn into a font A cell, the way ESC & wants it: column by
+        column from the left, 3 bytes per column with the top dot in the high bit
+        """
+        data = self._glyphs.get(char)
+
+        if data is not None:
+            return data
+
+        # Room on both sides for glyphs that hang out of their box
+        image = Image.new("L", (CHAR_WIDTH * 3, CHAR_HEIGHT), 0)
+        ImageDraw.Draw(image).text((CHAR_WIDTH, 0), char, fill=255, font=self.font)
+        cell = Image.new("L", (CHAR_WIDTH, CHAR_HEIGHT), 0)
+        box = image.getbbox()
+
+        # Fonts without the character draw nothing, that leaves a blank space
+        if box:
+            ink = image.crop((box[0], 0, box[2], CHAR_HEIGHT))
+
+            if ink.width > CHAR_WIDTH:
+                ink = ink.resize((CHAR_WIDTH, CHAR_HEIGHT))
+
+            cell.paste(ink, ((CHAR_WIDTH - ink.width) // 2, 0))
+
+        dots = np.asarray(cell) >= 128
+        data = np.packbits(dots.T, axis=1).tobytes()
+        self._glyphs[char] = data
+
+        return data
+
+    def _define(self, codes):
+        """
+        ESC & y c1 c2 [x d1...d(y * x)]... defines the characters from c1 to c2,
+        y is the height in bytes and x the width in dots
+        """
+        first, last = min(codes.values()), max(codes.values())
+        command = [ESC + b"&" + bytes([CHAR_HEIGHT // 8, first, last])]
+
+        for char in codes:
+            command.append(bytes([CHAR_WIDTH]) + self.glyph(char))
+
+        return b"".join(command)
+
+
+def _printable(char):
+    if char < " ":
+        return False
+
+    try:
+        char.encode(CODE_PAGE)
+    except UnicodeEncodeError:
+        return False
+
+    return True
+
+
+def _encode_line(text, codes):
+    """
+    Encodes a line for the code page. Runs of user-defined characters go
+    between ESC % 1 and ESC % 0, which switch them on and back off.
+    """
+    encoded = []
+    user = False
+
+    for char in text:
+        code = codes.get(char)
+
+        if (code is not None) != user:
+            user = not user
+            encoded.append(ESC + b"%" + (b"\x01" if user else b"\x00"))
+
+        if code is not None:
+            encoded.append(bytes([code]))
+        elif _printable(char):
+            encoded.append(char.encode(CODE_PAGE))
+        else:
+            # Control characters, or more missing characters than there are codes
+            encoded.append(b"?" if char >= " " else b" ")
+
+    if user:
+        encoded.append(ESC + b"%\x00")
+
+    return b"".join(encoded)
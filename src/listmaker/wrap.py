@@ -0,0 +1,116 @@
+import numpy as np
+import re
+
+from glyphs import GlyphAtlas
+
+WORD = re.compile(r"\S+")
+
+
+class Wrapper:
+    def __init__(self, atlas: GlyphAtlas):
+        """
+        Wraps text by its actual width in pixels.
+
+        The width of every character comes from the font's glyph atlas
+        and is kept in a table, so measuring never goes back to FreeType.
+        Prefix sums of those widths give the width of any piece of text
+        with a single subtraction, which keeps wrapping a single pass
+        over the words, no matter how long the text is.
+
+        Like textwrap, whitespace between words is kept as spaces and
+        whitespace at the start and end of a line is dropped.
+        """
+        self.atlas = atlas
+        self.advances = {}
+
+    def advance(self, char) -> float:
+        advance = self.advances.get(char)
+
+        if advance is None:
+            # Tabs etc. end up as spaces, so they're as wide as one
+            advance = self.atlas.glyph(" " if char.isspace() else char).advance
+            self.advances[char] = advance
+
+        return advance
+
+    def wrap(self, text, width, indent=0) -> list:
+        """
+        Splits text into lines that are at most width pixels wide.
+        Words that don't fit on a line by themselves get split up.
+
+        Line breaks in the text are kept, every paragraph is wrapped on its
+        own and an empty one is an empty line, same as TextList.lines().
+
+        :param text: The text to wrap
+        :param width: Max width of a line in pixels
+        :param indent: Pixels taken off the width of every line after the first
+        :return: The lines, empty if the text is blank
+        """
+        paragraphs = text.splitlines()
+
+        if len(paragraphs) <= 1:
+            return self._wrap(text, width, width - indent)
+
+        lines = []
+
+        for paragraph in paragraphs:
+            lines.extend(self._wrap(paragraph, width - indent if lines else width, width - indent) or [""])
+
+        return lines
+
+    def _wrap(self, text, first_width, width) -> list:
+        """
+        Wraps a single paragraph, the first line can be first_width wide, the others width
+        """
+        advances = np.fromiter(map(self.advance, text), dtype=np.float64, count=len(text))
+        # prefix[i] is the width of text[:i]
+        prefix = np.concatenate(([0.0], np.cumsum(advances)))
+
+        lines = []
+        start = end = None
+        available = first_width
+
+        def finish(line_start, line_end):
+            nonlocal available
+            lines.append(text[line_start:line_end])
+            available = width
+
+        for word in WORD.finditer(text):
+            word_start, word_end = word.span()
+
+            if start is not None:
+                # Try to fit the word on the current line, spaces in between included
+                if prefix[word_end] - prefix[start] <= available:
+                    end = word_end
+                    continue
+
+                # A word too long for any line gets broken up starting right
+                # here, same as textwrap, instead of leaving this line half empty
+                if prefix[word_end] - prefix[word_start] <= width:
+                    finish(start, end)
+                    start = word_start
+            else:
+                start = word_start
+
+            # Break up words that are too long for a whole line
+            while prefix[word_end] - prefix[start] > available:
+                # Last position that still fits, but always at least one character
+                fits = np.searchsorted(prefix, prefix[start] + available, side="right") - 1
+                split = max(fits, start + 1)
+
+                if start < word_start and split <= word_start:
+                    # Not even a piece of the word fits after what's already on the line
+                    finish(start, end)
+                    start = word_start
+                    continue
+
+                finish(start, split)
+                start = split
+
+            end = word_end
+
+        if start is not None:
+            lines.append(text[start:end])
+
+        # Same as textwrap, whitespace inside a line becomes plain spaces
+        return [re.sub(r"\s", " ", line) for line in lines]